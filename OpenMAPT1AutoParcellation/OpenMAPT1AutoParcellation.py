@@ -33,6 +33,12 @@ import numpy as np
 import pandas as pd
 import zipfile
 import shutil
+import contextlib
+import gc
+import queue
+import threading
+import traceback
+from types import SimpleNamespace
 
 # Add module lib to path
 import sys
@@ -43,18 +49,42 @@ if lib_path not in sys.path:
 
 # Attempt to import OpenMAP utils
 try:
-    from utils.cropping import cropping
-    from utils.hemisphere import hemisphere
-    from utils.load_model import load_model
-    from utils.parcellation import parcellation
-    from utils.preprocessing import preprocessing
-    from utils.stripping import stripping
-    from utils.postprocessing import postprocessing
+    from utils.load_model import _build_options, clear_model_cache, load_model
+    from utils.pipeline import PROGRESS_WEIGHTS, run_inference
+    from utils.preprocessing import n4_cache_settings, n4_settings
+    from utils.profiling import run_report, stage
+    from utils.progress import Cancelled, Progress, track
+    from utils.result_cache import ResultCache
+    from utils.scheduler import Task, run_graph
 except Exception as e:
     utils_import_error = str(e)
 else:
     utils_import_error = None
 
+class PipelineJob:
+    """
+    Runs fn(log) on a background thread, with a Progress that the pipeline reports into and that cancels it.
+
+    Messages passed to log are queued for the main thread, and the result or the exception of fn is kept
+    for it, since the scene and the widgets may only be changed from the main thread.
+    """
+
+    def __init__(self, fn, progress):
+        self.progress = progress
+        self.messages = queue.Queue()
+        self.result = None
+        self.error = None
+        self.traceback = None
+        self.thread = threading.Thread(target=self._run, args=(fn,), daemon=True)
+
+    def _run(self, fn):
+        try:
+            with track(self.progress):
+                self.result = fn(self.messages.put)
+        except Exception as e:
+            self.error = e
+            self.traceback = traceback.format_exc()
+
 class OpenMAPT1AutoParcellation(slicer.ScriptedLoadableModule.ScriptedLoadableModule):
     def __init__(self, parent):
         super().__init__(parent)
@@ -74,6 +104,7 @@ class OpenMAPT1AutoParcellationWidget(slicer.ScriptedLoadableModule.ScriptedLoad
         self.layout = self.parent.layout()
         self.resultDataFrame = None
         self.outputFolder = None
+        self.job = None
 
         # Info
         info = qt.QLabel(
@@ -115,6 +146,23 @@ class OpenMAPT1AutoParcellationWidget(slicer.ScriptedLoadableModule.ScriptedLoad
         self.runButton.clicked.connect(self.onRunClicked)
         self.layout.addWidget(self.runButton)
 
+        # The pipeline runs in the background and stops at its next stage or batch of slices when cancelled
+        self.cancelButton = qt.QPushButton("Cancel")
+        self.cancelButton.enabled = False
+        self.cancelButton.setVisible(False)
+        self.cancelButton.clicked.connect(self.onCancelClicked)
+        self.layout.addWidget(self.cancelButton)
+
+        # Debug output
+        self.saveIntermediatesCheckBox = qt.QCheckBox("Save intermediate images (debug)")
+        self.saveIntermediatesCheckBox.checked = False
+        self.layout.addWidget(self.saveIntermediatesCheckBox)
+
+        # Traced models skip the Python overhead of every layer; the graphs are cached in MODEL_FOLDER/traced
+        self.traceCheckBox = qt.QCheckBox("Use traced models (faster after the first run)")
+        self.traceCheckBox.checked = False
+        self.layout.addWidget(self.traceCheckBox)
+
         # --- EXCEL EXPORT ---
         exportGroup = qt.QGroupBox("Export Results")
         exportLayout = qt.QVBoxLayout()
@@ -133,6 +181,11 @@ class OpenMAPT1AutoParcellationWidget(slicer.ScriptedLoadableModule.ScriptedLoad
         self.progressBar.setVisible(False)
         self.layout.addWidget(self.progressBar)
 
+        # Polls the log and progress of a running pipeline
+        self.pollTimer = qt.QTimer()
+        self.pollTimer.setInterval(200)
+        self.pollTimer.timeout.connect(self.onPollTimer)
+
         # Log
         self.layout.addWidget(qt.QLabel("Log:"))
         self.log = qt.QTextEdit()
@@ -175,6 +228,8 @@ class OpenMAPT1AutoParcellationWidget(slicer.ScriptedLoadableModule.ScriptedLoad
 
     def downloadModels(self):
         model_folder = os.path.join(self.moduleDir, "MODEL_FOLDER")
+        if not utils_import_error:
+            clear_model_cache()
         if os.path.exists(model_folder):
             shutil.rmtree(model_folder)
         try:
@@ -255,6 +310,8 @@ class OpenMAPT1AutoParcellationWidget(slicer.ScriptedLoadableModule.ScriptedLoad
     # ========== RUN PIPELINE ==========
 
     def onRunClicked(self):
+        if self.job is not None:
+            return
         try:
             model_folder = os.path.join(self.moduleDir, "MODEL_FOLDER")
             if not os.path.exists(model_folder) or not os.listdir(model_folder):
@@ -262,10 +319,23 @@ class OpenMAPT1AutoParcellationWidget(slicer.ScriptedLoadableModule.ScriptedLoad
                 return
             self.runPipeline()
         except Exception as e:
+            self.finishRun()
             self.logMessage("ERROR: " + str(e))
             import traceback
             self.logMessage(traceback.format_exc())
 
+    def onCancelClicked(self):
+        if self.job is not None:
+            self.job.progress.cancel()
+            self.cancelButton.enabled = False
+            self.logMessage("Cancelling...")
+
+    def cleanup(self):
+        # Closing the module stops a running pipeline at its next stage or batch of slices
+        if self.job is not None:
+            self.job.progress.cancel()
+        self.pollTimer.stop()
+
     def runPipeline(self):
         if utils_import_error:
             raise RuntimeError("utils import failed: " + utils_import_error)
@@ -282,97 +352,208 @@ class OpenMAPT1AutoParcellationWidget(slicer.ScriptedLoadableModule.ScriptedLoad
         os.makedirs(output_folder, exist_ok=True)
         self.outputFolder = output_folder
 
-        tmp_t1_path = os.path.join(output_folder, "T1_tmp.nii.gz")
-        slicer.util.saveNode(volumeNode, tmp_t1_path)
-        self.logMessage("T1 saved.")
+        # Everything that reads the scene or the widgets happens here, on the main thread
+        import sitkUtils
+        t1_image = sitkUtils.PullVolumeFromSlicer(volumeNode)
+        save_intermediates = self.saveIntermediatesCheckBox.checked
+        if save_intermediates:
+            slicer.util.saveNode(volumeNode, os.path.join(output_folder, "T1_tmp.nii.gz"))
+            self.logMessage("T1 saved.")
+        trace = self.traceCheckBox.checked
+        label_dict = self.loadLabels()
+
+        # Per-stage timings and memory use are written next to the outputs; the report stays open until
+        # the results are in the scene
+        report = contextlib.ExitStack()
+        report.enter_context(run_report(os.path.join(output_folder, "T1_run_report.json"), input=volumeNode.GetName()))
+
+        # The pipeline runs on a background thread, so Slicer stays responsive; the timer shows its log and
+        # progress, and applies the results to the scene when it is done
+        self.job = PipelineJob(
+            lambda log: self.processVolume(t1_image, output_folder, save_intermediates, trace, label_dict, log),
+            Progress(PROGRESS_WEIGHTS),
+        )
+        self.job.volumeNode = volumeNode
+        self.job.labelDict = label_dict
+        self.job.report = report
+
+        self.runButton.enabled = False
+        self.downloadButton.enabled = False
+        self.cancelButton.enabled = True
+        self.cancelButton.setVisible(True)
+        self.progressBar.setRange(0, 100)
+        self.progressBar.setValue(0)
+        self.progressBar.setFormat("%p%")
+        self.progressBar.setVisible(True)
+        self.job.thread.start()
+        self.pollTimer.start()
+
+    def onPollTimer(self):
+        job = self.job
+        if job is None:
+            self.pollTimer.stop()
+            return
+
+        # Append directly, since processEvents in logMessage could re-enter this slot
+        while not job.messages.empty():
+            self.log.append(job.messages.get())
+        self.progressBar.setValue(int(100 * job.progress.fraction()))
+        if job.progress.message:
+            self.progressBar.setFormat(job.progress.message + " %p%")
+        if job.thread.is_alive():
+            return
 
-        # Load models
+        self.pollTimer.stop()
+        try:
+            if isinstance(job.error, Cancelled):
+                self.logMessage("Pipeline cancelled.")
+            elif job.error is not None:
+                self.logMessage("ERROR: " + str(job.error))
+                self.logMessage(job.traceback)
+            else:
+                self.progressBar.setValue(100)
+                self.applyResults(job.volumeNode, job.labelDict, *job.result)
+        except Exception as e:
+            self.logMessage("ERROR: " + str(e))
+            import traceback
+            self.logMessage(traceback.format_exc())
+        finally:
+            job.report.close()
+            # The result, and the traceback frames of the error, hold the volumes of the run; drop them and
+            # this reference to the job so that finishRun can free them
+            job.result = job.error = None
+            del job
+            self.finishRun()
+
+    def finishRun(self):
+        self.job = None
+        self.pollTimer.stop()
+        self.runButton.enabled = True
+        self.downloadButton.enabled = True
+        self.cancelButton.enabled = False
+        self.cancelButton.setVisible(False)
+        self.progressBar.setVisible(False)
+
+        # Release the volumes of a cancelled or failed run right away
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def processVolume(self, t1_image, output_folder, save_intermediates, trace, label_dict, log):
+        # Runs on the background thread of a PipelineJob: no scene or widget access here, log is thread-safe
         model_folder = os.path.join(self.moduleDir, "MODEL_FOLDER")
-        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-        self.logMessage("Loading models...")
-
-        class Opt:
-            m = model_folder
-
-        cnet, ssnet, pnet_c, pnet_s, pnet_a, hnet_c, hnet_a = load_model(Opt(), device)
-        self.logMessage("Models loaded.")
-
-        # Pipeline
-        self.logMessage("Preprocessing...")
-        odata, data = preprocessing(tmp_t1_path, output_folder, "T1")
-        self.logMessage("Cropping...")
-        cropped = cropping(data, cnet, device)
-        self.logMessage("Stripping...")
-        stripped, shift = stripping(cropped, data, ssnet, device)
-        self.logMessage("Parcellating...")
-        parcellated = parcellation(stripped, pnet_c, pnet_s, pnet_a, device)
-        self.logMessage("Hemisphere...")
-        separated = hemisphere(stripped, hnet_c, hnet_a, device)
-        self.logMessage("Postprocessing...")
-        aligned_output = postprocessing(parcellated, separated, shift, device)
-
-        # Load labels from labeled.txt
-        label_dict = self.loadLabels()
 
-        # Calculate volumes
-        self.logMessage("Calculating volumes...")
-        voxel_volume = np.prod(data.header.get_zooms())
-        unique_labels, counts = np.unique(aligned_output, return_counts=True)
-        mask = unique_labels != 0
-        unique_labels = unique_labels[mask]
-        counts = counts[mask]
-        volumes_mm3 = counts * voxel_volume
-
-        df = pd.DataFrame({
-            "LabelID": unique_labels.astype(int),
-            "Volume_mm3": volumes_mm3
-        })
-        if label_dict:
-            df["LabelName"] = df["LabelID"].map(label_dict).fillna("")
+        # Results are cached by input content, model weights and build options, so a re-imported scan returns
+        # instantly
+        model_opt = SimpleNamespace(m=model_folder, trace=trace)
+        result_cache = ResultCache(os.path.join(output_folder, "result_cache"), model_folder, variant=_build_options(model_opt))
+        cache_key = result_cache.key(t1_image, n4_cache_settings(n4_settings()))
+        cached = result_cache.get(cache_key)
+
+        if cached is not None:
+            log("Using cached result.")
+            aligned_output, affine, df = cached
+            df["LabelName"] = df["LabelName"].fillna("")
         else:
-            df["LabelName"] = ""
+            # Load models
+            device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+            log("Loading models...")
+
+            # Models stay cached for the rest of the Slicer session, so only the first run reads the checkpoints
+            models = load_model(model_opt, device)
+            log("Models loaded.")
+
+            # Pipeline
+            # Bias-corrected images are cached by content, so rerunning the same scan skips N4; the least
+            # recently used ones are removed beyond preprocessing.N4_CACHE_BYTES
+            data, aligned_output = run_inference(
+                t1_image,
+                output_folder,
+                "T1",
+                models,
+                device,
+                log=log,
+                save_intermediates=save_intermediates,
+                n4_cache_dir=os.path.join(output_folder, "n4_cache"),
+            )
+            affine = data.affine
+
+            # Calculate volumes
+            log("Calculating volumes...")
+            with stage("volumes"):
+                voxel_volume = abs(np.linalg.det(affine[:3, :3]))
+                unique_labels, counts = np.unique(aligned_output, return_counts=True)
+                mask = unique_labels != 0
+                unique_labels = unique_labels[mask]
+                counts = counts[mask]
+                volumes_mm3 = counts * voxel_volume
+
+                df = pd.DataFrame({
+                    "LabelID": unique_labels.astype(int),
+                    "Volume_mm3": volumes_mm3
+                })
+                if label_dict:
+                    df["LabelName"] = df["LabelID"].map(label_dict).fillna("")
+                else:
+                    df["LabelName"] = ""
+            result_cache.put(cache_key, aligned_output, affine, df)
 
-        # Save CSV
         csv_path = os.path.join(output_folder, "T1_280_volumes.csv")
-        df.to_csv(csv_path, index=False)
-        self.logMessage("CSV saved.")
+        excel_path = os.path.join(output_folder, "T1_280_volumes.xlsx")
+        out_label = os.path.join(output_folder, "T1_280_segment.nii.gz")
 
+        def save_excel():
+            try:
+                df.to_excel(excel_path, index=False, sheet_name="Brain_Volumes")
+            except Exception as e:
+                return e
+
+        def save_labelmap():
+            nii = nib.Nifti1Image(aligned_output.astype(np.uint16), affine=affine)
+            nib.save(nii, out_label)
+
+        # The CSV, Excel and labelmap files only depend on the results, so they are written concurrently;
+        # the Slicer scene is only changed from the main thread afterwards
+        results = run_graph(
+            [
+                Task("csv", lambda: df.to_csv(csv_path, index=False), threads=1),
+                Task("excel", save_excel, threads=1),
+                Task("save_labelmap", save_labelmap, threads=1),
+            ]
+        )
+        log("CSV saved.")
+        if results["excel"] is None:
+            log("Excel saved.")
+        else:
+            log("Excel auto-save failed: " + str(results["excel"]))
+        log("Labelmap saved.")
+        return df, out_label, output_folder
+
+    def applyResults(self, volumeNode, label_dict, df, out_label, output_folder):
         # Store for export
         self.resultDataFrame = df
         self.exportButton.setEnabled(True)
         self.exportPathLabel.setText("<small>Results ready. Click Export.</small>")
 
-        # Auto-save Excel too
-        try:
-            excel_path = os.path.join(output_folder, "T1_280_volumes.xlsx")
-            df.to_excel(excel_path, index=False, sheet_name="Brain_Volumes")
-            self.logMessage("Excel saved.")
-        except Exception as e:
-            self.logMessage("Excel auto-save failed: " + str(e))
-
-        # Save labelmap
-        nii = nib.Nifti1Image(aligned_output.astype(np.uint16), affine=data.affine)
-        out_label = os.path.join(output_folder, "T1_280_segment.nii.gz")
-        nib.save(nii, out_label)
-        self.logMessage("Labelmap saved.")
-
         # Load into Slicer 2D
-        labelNode = slicer.util.loadLabelVolume(out_label)
-        labelNode.SetName("OpenMAP_T1_Labelmap")
-        labelNode.SetAndObserveTransformNodeID(None)
-        labelNode.GetDisplayNode().SetOpacity(0.4)
-        slicer.util.setSliceViewerLayers(background=volumeNode, foreground=labelNode, foregroundOpacity=0.4)
+        with stage("load_labelmap"):
+            labelNode = slicer.util.loadLabelVolume(out_label)
+            labelNode.SetName("OpenMAP_T1_Labelmap")
+            labelNode.SetAndObserveTransformNodeID(None)
+            labelNode.GetDisplayNode().SetOpacity(0.4)
+            slicer.util.setSliceViewerLayers(background=volumeNode, foreground=labelNode, foregroundOpacity=0.4)
         self.logMessage("2D labelmap loaded.")
 
         # 3D Segmentation
         try:
             self.logMessage("Creating 3D segmentation...")
-            segNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSegmentationNode")
-            segNode.SetName("OpenMAP_T1_Segmentation")
-            segLogic = slicer.modules.segmentations.logic()
-            segLogic.ImportLabelmapToSegmentationNode(labelNode, segNode)
-            segNode.SetReferenceImageGeometryParameterFromVolumeNode(volumeNode)
-            segNode.CreateClosedSurfaceRepresentation()
+            with stage("segmentation"):
+                segNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSegmentationNode")
+                segNode.SetName("OpenMAP_T1_Segmentation")
+                segLogic = slicer.modules.segmentations.logic()
+                segLogic.ImportLabelmapToSegmentationNode(labelNode, segNode)
+                segNode.SetReferenceImageGeometryParameterFromVolumeNode(volumeNode)
+                segNode.CreateClosedSurfaceRepresentation()
 
             # Rename segments from labeled.txt
             if label_dict:
@@ -418,6 +599,6 @@ class OpenMAPT1AutoParcellationWidget(slicer.ScriptedLoadableModule.ScriptedLoad
 
         self.logMessage("=" * 50)
         self.logMessage("PIPELINE COMPLETED")
-        self.logMessage("Regions: " + str(len(unique_labels)))
+        self.logMessage("Regions: " + str(len(df)))
         self.logMessage("Output: " + output_folder)
         self.logMessage("=" * 50)
@@ -0,0 +1,186 @@
+"""
+Headless OpenMAP-T1 runner for cohorts of T1 volumes.
+
+Runs preprocessing, cropping, stripping, parcellation, hemisphere separation, postprocessing and the
+volume tables for every NIfTI file of a directory or manifest, with several subjects in parallel:
+
+    python openmap_batch.py -i INPUT_DIR_OR_MANIFEST -o OUTPUT_DIR -m MODEL_FOLDER -w 4
+
+Each worker process loads the models once and uses cpu_count / workers intra-op threads, so the
+workers together do not oversubscribe the CPU. The outputs of a subject go to OUTPUT_DIR/<basename>/.
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+from types import SimpleNamespace
+
+NIFTI_EXTENSIONS = (".nii.gz", ".nii")
+
+# Set in every worker process by _init_worker
+_worker = {}
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(description="Run OpenMAP-T1 on a directory or manifest of T1 volumes.")
+    parser.add_argument("-i", required=True, help="Input folder of NIfTI files, or a manifest with one path per line")
+    parser.add_argument("-o", required=True, help="Output folder")
+    parser.add_argument("-m", required=True, help="Model folder")
+    parser.add_argument("-l", default=None, help="Folder with the ROI level tables used for the volume CSVs (default: level, if present)")
+    parser.add_argument("-w", "--workers", type=int, default=1, help="Number of subjects processed concurrently")
+    parser.add_argument("-t", "--threads", type=int, default=None, help="Torch threads per worker (default: cpu_count / workers)")
+    parser.add_argument("--device", default=None, help="Torch device (default: cuda if available, else cpu; always cpu for --backend onnx and --int8)")
+    parser.add_argument("--precision", default="fp32", choices=["fp32", "bf16", "fp16"], help="Precision of the network forward passes")
+    parser.add_argument("--backend", default="torch", choices=["torch", "onnx"], help="Execution backend of the models (onnx runs on the CPU through ONNX Runtime)")
+    parser.add_argument("--parallel-views", action="store_true", help="Run the coronal, sagittal and axial views of each stage concurrently")
+    parser.add_argument("--channels-last", action="store_true", help="Run the models and input batches in channels_last (NHWC) memory format")
+    parser.add_argument("--trace", action="store_true", help="Run the models as TorchScript graphs traced once and cached in MODEL_FOLDER/traced")
+    parser.add_argument("--int8", action="store_true", help="Use the INT8 parcellation and hemisphere models created by openmap_quantize.py (CPU only)")
+    parser.add_argument("--n4-profile", default="default", help="N4 bias-field correction profile: default, fast or accurate")
+    parser.add_argument("--n4-cache", default=None, help="Folder caching bias-corrected images by input content")
+    parser.add_argument("--n4-cache-size", type=float, default=2.0, help="Size limit of the N4 cache in GB")
+    parser.add_argument("--result-cache", default=None, help="Folder caching whole-pipeline results by input content")
+    parser.add_argument("--result-cache-size", type=float, default=10.0, help="Size limit of the result cache in GB")
+    parser.add_argument("--save-intermediates", action="store_true", help="Also write the bias-corrected image of every subject")
+    return parser
+
+
+def basename_of(path):
+    name = os.path.basename(path)
+    for extension in NIFTI_EXTENSIONS:
+        if name.endswith(extension):
+            return name[: -len(extension)]
+    return os.path.splitext(name)[0]
+
+
+def collect_inputs(source):
+    """
+    Returns the NIfTI paths of an input directory, or the paths listed in a manifest file.
+
+    Blank lines and lines starting with '#' in a manifest are ignored; relative paths are resolved
+    against the directory of the manifest.
+    """
+    if os.path.isdir(source):
+        return sorted(
+            os.path.join(source, name) for name in os.listdir(source) if name.endswith(NIFTI_EXTENSIONS)
+        )
+    root = os.path.dirname(os.path.abspath(source))
+    paths = []
+    with open(source) as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                paths.append(line if os.path.isabs(line) else os.path.join(root, line))
+    return paths
+
+
+def _init_worker(model_folder, device, threads, result_cache_dir=None, result_cache_bytes=None, precision="fp32", trace=False, backend="torch", int8=False, channels_last=False, parallel_views=False):
+    import torch
+
+    from utils.inference import configure
+    from utils.load_model import _build_options, load_model
+    from utils.result_cache import ResultCache
+
+    torch.set_num_threads(threads)
+    configure(precision=precision, channels_last=channels_last, parallel_views=parallel_views)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        pass
+
+    opt = SimpleNamespace(m=model_folder, trace=trace, backend=backend, int8=int8, channels_last=channels_last)
+    _worker["device"] = torch.device(device)
+    _worker["models"] = load_model(opt, _worker["device"])
+    # The backend, INT8 models and other build options can change the labels, so their results are cached
+    # separately
+    variant = _build_options(opt)
+    _worker["result_cache"] = (
+        ResultCache(result_cache_dir, model_folder, result_cache_bytes, variant) if result_cache_dir else None
+    )
+
+
+def _run_subject(job):
+    from utils.pipeline import run_pipeline
+
+    ipath, output_dir, level_dir, save_intermediates, n4_profile, n4_cache_dir, n4_cache_bytes = job
+    basename = basename_of(ipath)
+    start = time.perf_counter()
+    try:
+        run_pipeline(
+            ipath,
+            os.path.join(output_dir, basename),
+            basename,
+            _worker["models"],
+            _worker["device"],
+            level_dir,
+            save_intermediates=save_intermediates,
+            n4_profile=n4_profile,
+            n4_cache_dir=n4_cache_dir,
+            n4_cache_bytes=n4_cache_bytes,
+            result_cache=_worker["result_cache"],
+        )
+    except Exception:
+        return ipath, False, time.perf_counter() - start, traceback.format_exc()
+    return ipath, True, time.perf_counter() - start, None
+
+
+def main(argv=None):
+    opt = create_parser().parse_args(argv)
+    inputs = collect_inputs(opt.i)
+    if not inputs:
+        print(f"No NIfTI files found in {opt.i}")
+        return 1
+
+    from utils.make_csv import missing_level_tables
+
+    # Check the level tables before any subject runs, instead of failing every subject after inference
+    level_dir = os.path.abspath(opt.l or "level")
+    missing = missing_level_tables(level_dir)
+    if missing and opt.l:
+        print(f"Missing level tables in {level_dir}: " + ", ".join(missing))
+        return 1
+    if missing:
+        print(f"No level tables in {level_dir}; writing the labelmaps only (pass -l to write the volume CSVs)")
+        level_dir = None
+
+    workers = max(1, min(opt.workers, len(inputs)))
+    threads = opt.threads or max(1, (os.cpu_count() or 1) // workers)
+    device = opt.device
+    if device is None:
+        import torch
+
+        # The ONNX backend and the INT8 models run on the CPU only
+        device = "cuda" if torch.cuda.is_available() and opt.backend == "torch" and not opt.int8 else "cpu"
+
+    # Inherited by the spawned workers before they import torch, so OpenMP pools are sized per worker
+    os.environ["OMP_NUM_THREADS"] = str(threads)
+    os.environ["MKL_NUM_THREADS"] = str(threads)
+
+    os.makedirs(opt.o, exist_ok=True)
+    n4_cache_dir = os.path.abspath(opt.n4_cache) if opt.n4_cache else None
+    result_cache_dir = os.path.abspath(opt.result_cache) if opt.result_cache else None
+    jobs = [
+        (ipath, opt.o, level_dir, opt.save_intermediates, opt.n4_profile, n4_cache_dir, int(opt.n4_cache_size * 1024**3))
+        for ipath in inputs
+    ]
+    print(f"{len(inputs)} subject(s), {workers} worker(s), {threads} thread(s) per worker, device {device}")
+
+    failed = 0
+    context = multiprocessing.get_context("spawn")
+    initargs = (opt.m, device, threads, result_cache_dir, int(opt.result_cache_size * 1024**3), opt.precision, opt.trace, opt.backend, opt.int8, opt.channels_last, opt.parallel_views)
+    with context.Pool(workers, initializer=_init_worker, initargs=initargs) as pool:
+        for done, (ipath, ok, seconds, error) in enumerate(pool.imap_unordered(_run_subject, jobs), 1):
+            status = "done" if ok else "FAILED"
+            print(f"[{done}/{len(jobs)}] {status} {ipath} ({seconds:.1f} s)")
+            if not ok:
+                failed += 1
+                print(error, file=sys.stderr)
+
+    print(f"{len(jobs) - failed} succeeded, {failed} failed")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
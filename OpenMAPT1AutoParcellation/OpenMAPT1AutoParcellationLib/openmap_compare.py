@@ -0,0 +1,136 @@
+"""
+Compares the labels of a faster inference configuration with the float32 PyTorch run on real T1 volumes.
+
+Reduced precision (--precision bf16 or fp16), the INT8 models (--int8), the ONNX backend (--backend onnx)
+and skipping slices of pure background (--skip-empty) can change labels. This runs the whole pipeline on every input volume with the trained
+models, once in float32 and once with the chosen configuration, and writes the Dice coefficient of every
+one of the 280 labels to <report_dir>/agreement_dice.csv and the voxel agreement (see
+functions.label_agreement) to <report_dir>/agreement.csv:
+
+    python openmap_compare.py -i EVALUATION_DIR_OR_MANIFEST -m MODEL_FOLDER --precision bf16 -o report_dir
+
+The run fails if the mean Dice of any volume is below --min-dice.
+"""
+import argparse
+import os
+import sys
+import tempfile
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+import torch
+
+from openmap_batch import basename_of, collect_inputs
+from utils.functions import dice_per_label, label_agreement
+from utils.inference import configure
+from utils.load_model import load_model
+from utils.pipeline import run_inference
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(description="Compare OpenMAP-T1 labels of a faster configuration with float32.")
+    parser.add_argument("-i", required=True, help="Folder or manifest of evaluation T1 volumes")
+    parser.add_argument("-m", required=True, help="Model folder")
+    parser.add_argument("-o", default=".", help="Folder of the agreement report")
+    parser.add_argument("--precision", default="fp32", choices=["fp32", "bf16", "fp16"], help="Precision of the compared run")
+    parser.add_argument("--backend", default="torch", choices=["torch", "onnx"], help="Execution backend of the compared run")
+    parser.add_argument("--int8", action="store_true", help="Use the INT8 parcellation and hemisphere models in the compared run")
+    parser.add_argument("--skip-empty", action="store_true", help="Skip the slices of pure background in the compared run")
+    parser.add_argument("--device", default=None, help="Torch device (default: cpu for --int8 and --backend onnx, else cuda if available)")
+    parser.add_argument("--min-dice", type=float, default=0.9, help="Smallest acceptable mean Dice per volume")
+    parser.add_argument("-t", "--threads", type=int, default=None, help="Torch threads")
+    return parser
+
+
+def run_labels(ipath, output_dir, basename, models, device, precision="fp32", skip_empty=False):
+    """
+    Runs the pipeline on one volume with the given inference options and returns its labelmap.
+    """
+    previous = configure(precision=precision, skip_empty=skip_empty)
+    try:
+        _, labels = run_inference(ipath, output_dir, basename, models, device)
+    finally:
+        configure(**previous)
+    return labels
+
+
+def compare(inputs, reference_models, models, device, precision="fp32", log=print, skip_empty=False):
+    """
+    Runs the pipeline with the float32 reference models and with the compared models, and compares the labels.
+
+    Args:
+        inputs (list of str): The T1 volumes.
+        reference_models (tuple): The float32 models returned by load_model.
+        models (tuple): The compared models returned by load_model.
+        device (torch.device): The device of both model sets.
+        precision (str): The precision of the compared run.
+        log (callable): Called with progress messages.
+        skip_empty (bool): Whether the compared run skips the slices of pure background.
+
+    Returns:
+        tuple: A tuple containing:
+            - dice (pandas.DataFrame): The Dice coefficient of labels 1-280, one row per volume.
+            - agreement (pandas.DataFrame): The voxel agreement of every volume, see functions.label_agreement.
+    """
+    dice, agreement = {}, {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for i, ipath in enumerate(inputs, 1):
+            log(f"[{i}/{len(inputs)}] comparing on {ipath}")
+            basename = basename_of(ipath)
+            reference = run_labels(ipath, tmp, basename, reference_models, device)
+            labels = run_labels(ipath, tmp, basename, models, device, precision, skip_empty)
+            dice[basename] = dice_per_label(reference, labels, 281)[1:]
+            agreement[basename] = label_agreement(reference, labels)
+    dice = pd.DataFrame.from_dict(dice, orient="index", columns=range(1, 281))
+    return dice, pd.DataFrame.from_dict(agreement, orient="index")
+
+
+def summarize(dice, min_dice):
+    """
+    Prints the mean and lowest Dice of every volume.
+
+    Returns:
+        bool: Whether the mean Dice of every volume is at least min_dice.
+    """
+    mean_dice = dice.mean(axis=1, skipna=True)
+    for uid, value in mean_dice.items():
+        worst = dice.loc[uid].idxmin()
+        print(f"{uid}: mean Dice {value:.4f}, lowest {dice.loc[uid, worst]:.4f} (label {worst})")
+    return not ((mean_dice < min_dice).any() or np.isnan(mean_dice).any())
+
+
+def main(argv=None):
+    opt = create_parser().parse_args(argv)
+    if opt.precision == "fp32" and opt.backend == "torch" and not opt.int8 and not opt.skip_empty:
+        print("Nothing to compare: choose --precision, --backend, --int8 or --skip-empty")
+        return 1
+    if opt.threads:
+        torch.set_num_threads(opt.threads)
+    inputs = collect_inputs(opt.i)
+    if not inputs:
+        print(f"No NIfTI files found in {opt.i}")
+        return 1
+
+    device = opt.device
+    if device is None:
+        device = "cuda" if torch.cuda.is_available() and not opt.int8 and opt.backend == "torch" else "cpu"
+    device = torch.device(device)
+    reference_models = load_model(SimpleNamespace(m=opt.m), device, cache=False)
+    models = load_model(SimpleNamespace(m=opt.m, backend=opt.backend, int8=opt.int8), device, cache=False)
+
+    dice, agreement = compare(inputs, reference_models, models, device, opt.precision, skip_empty=opt.skip_empty)
+    os.makedirs(opt.o, exist_ok=True)
+    dice.to_csv(os.path.join(opt.o, "agreement_dice.csv"), index_label="uid")
+    agreement.to_csv(os.path.join(opt.o, "agreement.csv"), index_label="uid")
+    acceptable = summarize(dice, opt.min_dice)
+    print(f"Reports written to {opt.o}")
+    if not acceptable:
+        print(f"The configuration is NOT acceptable: mean Dice below {opt.min_dice}")
+        return 1
+    print("The configuration is acceptable for these volumes")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,130 @@
+"""
+Creates the INT8 parcellation and hemisphere models and reports their accuracy against float32.
+
+The PNet and HNet models are quantised with post-training static quantisation. The activation ranges are
+calibrated on a few local T1 volumes, and the INT8 models are saved to MODEL_FOLDER/int8, where load_model
+picks them up when opt.int8 is set (openmap_batch.py --int8):
+
+    python openmap_quantize.py -c CALIBRATION_DIR_OR_MANIFEST -m MODEL_FOLDER -e EVALUATION_DIR -o report_dir
+
+With -e, the whole pipeline is run on every evaluation volume with the float32 and the INT8 models, and the
+Dice coefficient of every one of the 280 labels is written to <report_dir>/int8_dice.csv. The run fails
+if the mean Dice of any volume is below --min-dice, so the report decides whether INT8 is acceptable for
+the scans of a site. Use evaluation volumes that were not used for calibration.
+"""
+import argparse
+import os
+import sys
+import tempfile
+from types import SimpleNamespace
+
+import torch
+
+from openmap_batch import basename_of, collect_inputs
+from openmap_compare import compare, summarize
+from utils.cropping import cropping
+from utils.functions import NormalizedVolume
+from utils.hemisphere import hemisphere
+from utils.load_model import MODEL_FILES, file_fingerprint, load_model
+from utils.parcellation import parcellation
+from utils.preprocessing import preprocessing
+from utils.quantization import QUANTIZED_FILES, convert, prepare, quantized_path, save_quantized
+from utils.stripping import stripping
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(description="Create INT8 OpenMAP-T1 models and report their accuracy.")
+    parser.add_argument("-c", "--calibration", required=True, help="Folder or manifest of calibration T1 volumes")
+    parser.add_argument("-m", required=True, help="Model folder")
+    parser.add_argument("-e", "--evaluation", default=None, help="Folder or manifest of evaluation T1 volumes")
+    parser.add_argument("-o", default=".", help="Folder of the Dice report")
+    parser.add_argument("--int8-dir", default=None, help="Where to save the INT8 models (default: MODEL_FOLDER/int8)")
+    parser.add_argument("--min-dice", type=float, default=0.9, help="Smallest acceptable mean Dice per volume")
+    parser.add_argument("-t", "--threads", type=int, default=None, help="Torch threads")
+    return parser
+
+
+def quantize_models(model_folder, calibration_inputs, int8_dir, log=print):
+    """
+    Calibrates and saves the INT8 versions of the parcellation and hemisphere models.
+
+    Args:
+        model_folder (str): The folder of the float32 checkpoints.
+        calibration_inputs (list of str): The T1 volumes used for calibration.
+        int8_dir (str): The folder of the INT8 models.
+        log (callable): Called with progress messages.
+    """
+
+    # FX quantisation fuses conv, BatchNorm and ReLU itself, so the BatchNorm layers are kept here
+    device = torch.device("cpu")
+    models = load_model(SimpleNamespace(m=model_folder, fuse_bn=False), device, cache=False)
+    cnet, ssnet = models[:2]
+    ch_in = {name: ch_in for name, ch_in, _ in MODEL_FILES}
+    names = [name for name, _, _ in MODEL_FILES]
+    prepared = {name: prepare(models[names.index(name)], ch_in[name]) for name in QUANTIZED_FILES}
+
+    # Run the parcellation and hemisphere stages with the observed models on the stripped calibration volumes
+    with tempfile.TemporaryDirectory() as tmp:
+        for i, ipath in enumerate(calibration_inputs, 1):
+            log(f"[{i}/{len(calibration_inputs)}] calibrating on {ipath}")
+            _, data = preprocessing(ipath, tmp, basename_of(ipath))
+            cropped = cropping(data, cnet, device)
+            stripped, _ = stripping(cropped, data, ssnet, device)
+            normalized = NormalizedVolume(stripped)
+            parcellation(normalized, *(prepared[name] for name in QUANTIZED_FILES[:3]), device)
+            hemisphere(normalized, *(prepared[name] for name in QUANTIZED_FILES[3:]), device)
+
+    for name in QUANTIZED_FILES:
+        path = quantized_path(int8_dir, name)
+        checkpoint_hash = file_fingerprint(os.path.join(model_folder, name), content_hash=True)[2]
+        save_quantized(convert(prepared[name], ch_in[name]), path, checkpoint_hash)
+        log(f"saved {path}")
+
+
+def dice_report(model_folder, evaluation_inputs, int8_dir, log=print):
+    """
+    Runs the pipeline with the float32 and the INT8 models and compares the labelmaps.
+
+    Returns:
+        pandas.DataFrame: The Dice coefficient of labels 1-280, one row per evaluation volume.
+    """
+    device = torch.device("cpu")
+    float_models = load_model(SimpleNamespace(m=model_folder), device, cache=False)
+    int8_models = load_model(SimpleNamespace(m=model_folder, int8=True, int8_dir=int8_dir), device, cache=False)
+    return compare(evaluation_inputs, float_models, int8_models, device, log=log)[0]
+
+
+def main(argv=None):
+    opt = create_parser().parse_args(argv)
+    if opt.threads:
+        torch.set_num_threads(opt.threads)
+    int8_dir = opt.int8_dir or os.path.join(opt.m, "int8")
+
+    calibration_inputs = collect_inputs(opt.calibration)
+    if not calibration_inputs:
+        print(f"No NIfTI files found in {opt.calibration}")
+        return 1
+    quantize_models(opt.m, calibration_inputs, int8_dir)
+
+    if opt.evaluation is None:
+        return 0
+    evaluation_inputs = collect_inputs(opt.evaluation)
+    if not evaluation_inputs:
+        print(f"No NIfTI files found in {opt.evaluation}")
+        return 1
+    report = dice_report(opt.m, evaluation_inputs, int8_dir)
+    os.makedirs(opt.o, exist_ok=True)
+    report_path = os.path.join(opt.o, "int8_dice.csv")
+    report.to_csv(report_path, index_label="uid")
+
+    acceptable = summarize(report, opt.min_dice)
+    print(f"Dice per label written to {report_path}")
+    if not acceptable:
+        print(f"INT8 is NOT acceptable: mean Dice below {opt.min_dice}")
+        return 1
+    print("INT8 is acceptable for these volumes")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,11 +1,11 @@
 import numpy as np
-import torch
 from scipy.ndimage import binary_closing
 
-from utils.functions import normalize
+from utils.functions import NormalizedVolume
+from utils.inference import infer_slices, run_views
 
 
-def crop(voxel, model, device):
+def crop(voxel, model, device, batch_size=None):
     """
     Crops the given voxel data using the provided model and device.
 
@@ -13,19 +13,13 @@ def crop(voxel, model, device):
         voxel (numpy.ndarray): The input voxel data to be cropped, expected to be of shape (N, 256, 256).
         model (torch.nn.Module): The PyTorch model used for cropping.
         device (torch.device): The device (CPU or GPU) on which the computation will be performed.
+        batch_size (int, optional): The number of slices per forward pass. Defaults to the configured value.
 
     Returns:
         torch.Tensor: The cropped output tensor of shape (256, 256, 256).
     """
-    model.eval()
-    with torch.inference_mode():
-        output = torch.zeros(256, 256, 256).to(device)
-        for i, v in enumerate(voxel):
-            image = v.reshape(1, 1, 256, 256)
-            image = torch.tensor(image).to(device)
-            x_out = torch.sigmoid(model(image)).detach()
-            output[i] = x_out
-        return output.reshape(256, 256, 256)
+    output = infer_slices(voxel, model, device, 1, activation="sigmoid", batch_size=batch_size)
+    return output.reshape(256, 256, 256)
 
 
 def closing(voxel):
@@ -56,17 +50,22 @@ def cropping(data, cnet, device):
         device (torch.device): The device (CPU or GPU) on which the model is run.
 
     Returns:
-        numpy.ndarray: The cropped medical imaging data.
+        numpy.ndarray: The cropped medical imaging data as float32.
     """
-    voxel = data.get_fdata()
-    voxel = normalize(voxel)
+    # The float32 voxels are loaded once and kept by the image for stripping
+    voxel = data.get_fdata(dtype=np.float32)
+    normalized = NormalizedVolume(voxel).voxel
 
-    coronal = voxel.transpose(1, 2, 0)
-    sagittal = voxel
-    out_c = crop(coronal, cnet, device).permute(2, 0, 1)
-    out_s = crop(sagittal, cnet, device)
+    coronal = normalized.transpose(1, 2, 0)
+    sagittal = normalized
+    out_c, out_s = run_views(
+        ("cropping.coronal", len(coronal), lambda: crop(coronal, cnet, device).permute(2, 0, 1)),
+        ("cropping.sagittal", len(sagittal), lambda: crop(sagittal, cnet, device)),
+    )
     out_e = ((out_c + out_s) / 2) > 0.5
     out_e = out_e.cpu().numpy()
     out_e = closing(out_e)
-    cropped = data.get_fdata() * out_e
+
+    # The normalized voxels are no longer needed, so their buffer receives the masked image
+    cropped = np.multiply(voxel, out_e, out=normalized)
     return cropped
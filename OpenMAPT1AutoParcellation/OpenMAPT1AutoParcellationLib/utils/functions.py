@@ -1,9 +1,287 @@
+import hashlib
+import os
+import shutil
+import threading
+from contextlib import contextmanager
+from functools import lru_cache
+
 import numpy as np
+import torch
+
+
+# The box that stripping cuts out of the centred 256^3 volume, as (start, stop) along every axis
+BRAIN_BOX = ((32, 224), (16, 240), (32, 224))
+
+
+def box_index(shift, shape=(256, 256, 256)):
+    """
+    Returns the index of the brain box in a volume that is rolled by shift, without rolling the volume.
+
+    volume[box_index(shift)] equals np.roll(volume, shift, axis=(0, 1, 2))[32:-32, 16:-16, 32:-32], but only
+    gathers the voxels of the box, and assigning to it places a box back where the inverse roll would.
+
+    Args:
+        shift (tuple of int): The roll along every axis.
+        shape (tuple of int): The shape of the volume.
+
+    Returns:
+        tuple: An open mesh index from np.ix_.
+    """
+    return np.ix_(*[(np.arange(start, stop) - s) % n for (start, stop), s, n in zip(BRAIN_BOX, shift, shape)])
+
+
+class NormalizedVolume:
+    """
+    A volume clipped to [0, mean + 2 * std] of its positive voxels and scaled to [-1, 1] as float32.
+
+    The statistics are collected in one streaming pass over blocks of slices, combining the mean and the
+    sum of squared deviations of every block, and the scaled volume is written block by block into a single
+    float32 array, so no full-size temporaries are created. Compute it once per input and pass it to every
+    stage that normalises the same volume, e.g. parcellation and hemisphere.
+
+    Args:
+        voxel (numpy.ndarray): The volume, with the slices along the first axis.
+        block_slices (int): The number of slices processed at a time.
+
+    Attributes:
+        voxel (numpy.ndarray): The normalised float32 volume.
+        mean (float): The mean of the positive voxels.
+        std (float): The standard deviation of the positive voxels.
+        upper (float): The clipping limit, mean + 2 * std.
+    """
+
+    def __init__(self, voxel, block_slices=16):
+        voxel = np.asarray(voxel)
+        count, mean, m2 = 0, 0.0, 0.0
+        low, high = np.inf, -np.inf
+        for start in range(0, len(voxel), block_slices):
+            block = voxel[start:start + block_slices]
+            low, high = min(low, block.min()), max(high, block.max())
+            positive = block[block > 0].astype("float64")
+            if positive.size == 0:
+                continue
+            # Combine the block statistics with the running ones (Chan et al.)
+            block_mean = positive.mean()
+            block_m2 = np.square(positive - block_mean).sum()
+            total = count + positive.size
+            delta = block_mean - mean
+            mean += delta * positive.size / total
+            m2 += block_m2 + delta**2 * count * positive.size / total
+            count = total
+
+        self.mean = mean if count else np.nan
+        self.std = np.sqrt(m2 / count) if count else np.nan
+        self.upper = self.mean + self.std * 2
+        low, high = np.clip(low, 0, self.upper), np.clip(high, 0, self.upper)
+
+        self.voxel = np.empty(voxel.shape, dtype="float32")
+        for start in range(0, len(voxel), block_slices):
+            # Scale in float64, block by block, so float32 and float64 inputs give the same voxels
+            block = np.clip(voxel[start:start + block_slices].astype("float64"), 0, self.upper)
+            block = (block - low) / (high - low)
+            self.voxel[start:start + block_slices] = (block * 2) - 1
+
+
+def as_normalized(voxel):
+    """
+    Returns the normalised voxels of a NormalizedVolume, or normalises a raw volume.
+    """
+    if isinstance(voxel, NormalizedVolume):
+        return voxel.voxel
+    return NormalizedVolume(voxel).voxel
 
 
 def normalize(voxel):
-    nonzero = voxel[voxel > 0]
-    voxel = np.clip(voxel, 0, np.mean(nonzero) + np.std(nonzero) * 2)
-    voxel = (voxel - np.min(voxel)) / (np.max(voxel) - np.min(voxel))
-    voxel = (voxel * 2) - 1
-    return voxel.astype("float32")
+    return NormalizedVolume(voxel).voxel
+
+
+def available_memory(device):
+    """
+    Returns the number of bytes currently available for tensors on the given device.
+
+    Args:
+        device (torch.device): The device (CPU or GPU) to query.
+
+    Returns:
+        int or None: The available memory in bytes, or None if it cannot be determined.
+    """
+    device = torch.device(device)
+    if device.type == "cuda":
+        free, _ = torch.cuda.mem_get_info(device)
+        return free
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def auto_batch_size(device, ch_in, ch_out, height, width, max_batch_size=32, fraction=0.25):
+    """
+    Estimates how many slices can be sent through a UNet in one forward pass.
+
+    The estimate assumes the widest activations of the network (64 feature maps at full
+    resolution, kept alive for the skip connection and the decoder) plus the input and
+    output tensors, and only uses a fraction of the memory that is currently free.
+
+    Args:
+        device (torch.device): The device on which the model is run.
+        ch_in (int): The number of input channels of the model.
+        ch_out (int): The number of output channels of the model.
+        height (int): The height of a slice.
+        width (int): The width of a slice.
+        max_batch_size (int): The upper bound of the returned batch size.
+        fraction (float): The fraction of the available memory that may be used.
+
+    Returns:
+        int: The batch size, at least 1.
+    """
+    free = available_memory(device)
+    if free is None:
+        return 8
+    return int(max(1, min(max_batch_size, (free * fraction) // _slice_bytes(ch_in, ch_out, height, width))))
+
+
+def _slice_bytes(ch_in, ch_out, height, width):
+    # The float32 input, widest activations and output of one slice, as assumed by auto_batch_size
+    return height * width * 4 * (ch_in + 64 * 8 + ch_out * 2)
+
+
+def batch_memory(device, ch_in, ch_out, height, width):
+    """
+    Estimates the memory of one forward pass at the batch size that auto_batch_size chooses now.
+
+    Returns:
+        int: The estimate in bytes.
+    """
+    return auto_batch_size(device, ch_in, ch_out, height, width) * _slice_bytes(ch_in, ch_out, height, width)
+
+
+@lru_cache(maxsize=None)
+def per_thread_num_threads():
+    """
+    Returns whether torch.set_num_threads only changes the intra-op threads of the calling thread.
+
+    The parallel backend does not tell: builds with the OpenMP backend can keep one process-wide count as
+    well, and threads that set their own share of the CPU would then overwrite each other's. So this is
+    probed once per process, by two threads that set different counts and read them back once both have
+    set theirs. The thread count of the calling thread is restored afterwards.
+    """
+    threads = torch.get_num_threads()
+    barrier = threading.Barrier(2)
+    seen = {}
+
+    def probe(count):
+        torch.set_num_threads(count)
+        barrier.wait()
+        seen[count] = torch.get_num_threads()
+
+    workers = [threading.Thread(target=probe, args=(count,)) for count in (1, 2)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    torch.set_num_threads(threads)
+    return seen == {1: 1, 2: 2}
+
+
+def content_hash(*parts):
+    """
+    Computes a SHA-256 digest over arrays, bytes and other values.
+
+    Arrays contribute their dtype, shape and raw data; other values contribute their repr.
+
+    Args:
+        *parts: The numpy arrays, bytes or other values to hash, in order.
+
+    Returns:
+        str: The hexadecimal digest.
+    """
+    sha = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, np.ndarray):
+            sha.update(f"{part.dtype.str}{part.shape}".encode())
+            sha.update(memoryview(np.ascontiguousarray(part)).cast("B"))
+        elif isinstance(part, bytes):
+            sha.update(part)
+        else:
+            sha.update(repr(part).encode())
+    return sha.hexdigest()
+
+
+@contextmanager
+def atomic_path(path, suffix=""):
+    """
+    Yields a temporary path next to path and moves it to path when the with-block succeeds, so that
+    concurrent readers and processes never see a partial file. If the block fails, the temporary file or
+    directory is removed.
+
+    Args:
+        path (str): The final path.
+        suffix (str): Appended to the temporary name, for writers that choose the format by extension.
+    """
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp{suffix}"
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.isdir(tmp_path):
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        elif os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def label_agreement(reference, labels):
+    """
+    Compares two labelmaps, e.g. of a reduced-precision run against the float32 run.
+
+    Args:
+        reference (numpy.ndarray): The reference labelmap.
+        labels (numpy.ndarray): The labelmap to compare.
+
+    Returns:
+        dict: The number and fraction of differing voxels, the fraction among foreground voxels of the
+        reference, and the number of labels whose voxel count changed.
+    """
+    differ = reference != labels
+    foreground = reference != 0
+    n_labels = int(max(reference.max(), labels.max())) + 1
+    counts_reference = np.bincount(reference.ravel(), minlength=n_labels)
+    counts_labels = np.bincount(labels.ravel(), minlength=n_labels)
+    return {
+        "voxels_differing": int(differ.sum()),
+        "fraction_differing": float(differ.mean()),
+        "fraction_differing_foreground": float(differ[foreground].mean()) if foreground.any() else 0.0,
+        "labels_with_changed_volume": int((counts_reference != counts_labels).sum()),
+    }
+
+
+def dice_per_label(reference, labels, n_labels=None):
+    """
+    Computes the Dice coefficient of every label between two labelmaps.
+
+    Args:
+        reference (numpy.ndarray): The reference labelmap.
+        labels (numpy.ndarray): The labelmap to compare.
+        n_labels (int, optional): The number of labels, starting at 0. Defaults to the largest label + 1.
+
+    Returns:
+        numpy.ndarray: The Dice coefficient of every label, NaN for labels absent from both labelmaps.
+    """
+    reference, labels = reference.ravel(), labels.ravel()
+    if n_labels is None:
+        n_labels = int(max(reference.max(), labels.max())) + 1
+    counts_reference = np.bincount(reference, minlength=n_labels)[:n_labels]
+    counts_labels = np.bincount(labels, minlength=n_labels)[:n_labels]
+    overlap = np.bincount(reference[reference == labels], minlength=n_labels)[:n_labels]
+    total = (counts_reference + counts_labels).astype("float64")
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(total > 0, 2 * overlap / total, np.nan)
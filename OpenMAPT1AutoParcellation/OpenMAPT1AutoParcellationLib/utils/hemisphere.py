@@ -1,10 +1,11 @@
 import torch
 from scipy.ndimage import binary_dilation
 
-from utils.functions import normalize
+from utils.functions import as_normalized
+from utils.inference import infer_slices, run_views
 
 
-def separate(voxel, model, device, mode):
+def separate(voxel, model, device, mode, batch_size=None):
     """
     Separates the voxel data based on the specified mode and processes it using the given model.
 
@@ -13,6 +14,7 @@ def separate(voxel, model, device, mode):
         model (torch.nn.Module): The neural network model used for processing the voxel data.
         device (torch.device): The device (CPU or GPU) on which the model and data are loaded.
         mode (str): The mode of separation, either 'c' for coronal or 'a' for axial.
+        batch_size (int, optional): The number of slices per forward pass. Defaults to the configured value.
 
     Returns:
         torch.Tensor: The processed output tensor with shape (stack[0], 3, stack[1], stack[2]).
@@ -24,27 +26,11 @@ def separate(voxel, model, device, mode):
         # Set the stack dimensions for axial mode
         stack = (192, 224, 192)
 
-    # Set the model to evaluation mode
-    model.eval()
+    # Run the model on every slice and apply softmax
+    output = infer_slices(voxel, model, device, 3, activation="softmax", batch_size=batch_size)
 
-    # Disable gradient calculation for inference
-    with torch.inference_mode():
-        # Initialize an output tensor with the specified stack dimensions
-        output = torch.zeros(stack[0], 3, stack[1], stack[2]).to(device)
-
-        # Iterate over each slice in the voxel data
-        for i, v in enumerate(voxel):
-            # Reshape the slice and convert it to a tensor
-            image = torch.tensor(v.reshape(1, 1, stack[1], stack[2]))
-            # Move the tensor to the specified device
-            image = image.to(device)
-            # Perform a forward pass through the model and apply softmax
-            x_out = torch.softmax(model(image), 1).detach()
-            # Store the output in the corresponding slice of the output tensor
-            output[i] = x_out
-
-        # Return the processed output tensor
-        return output
+    # Return the processed output tensor
+    return output.reshape(stack[0], 3, stack[1], stack[2])
 
 
 def hemisphere(voxel, hnet_c, hnet_a, device):
@@ -52,7 +38,7 @@ def hemisphere(voxel, hnet_c, hnet_a, device):
     Processes a voxel image to separate and dilate hemispheres using neural networks.
 
     Args:
-        voxel (torch.Tensor): The input voxel image tensor.
+        voxel (numpy.ndarray or NormalizedVolume): The stripped volume, or its normalisation shared with parcellation.
         hnet_c (torch.nn.Module): The neural network model for coronal separation.
         hnet_a (torch.nn.Module): The neural network model for transverse separation.
         device (torch.device): The device to run the neural networks on (e.g., 'cpu' or 'cuda').
@@ -60,16 +46,18 @@ def hemisphere(voxel, hnet_c, hnet_a, device):
     Returns:
         numpy.ndarray: The processed and dilated mask of the hemispheres.
     """
-    # Normalize the voxel data
-    voxel = normalize(voxel)
+    # Normalize the voxel data, unless it was normalized already
+    voxel = as_normalized(voxel)
 
     # Transpose the voxel data for coronal and transverse views
     coronal = voxel.transpose(1, 2, 0)
     transverse = voxel.transpose(2, 1, 0)
 
     # Separate the coronal and transverse views using the respective models
-    out_c = separate(coronal, hnet_c, device, "c").permute(1, 3, 0, 2)
-    out_a = separate(transverse, hnet_a, device, "a").permute(1, 3, 2, 0)
+    out_c, out_a = run_views(
+        ("hemisphere.coronal", len(coronal), lambda: separate(coronal, hnet_c, device, "c").permute(1, 3, 0, 2)),
+        ("hemisphere.axial", len(transverse), lambda: separate(transverse, hnet_a, device, "a").permute(1, 3, 2, 0)),
+    )
 
     # Combine the outputs from both views
     out_e = out_c + out_a
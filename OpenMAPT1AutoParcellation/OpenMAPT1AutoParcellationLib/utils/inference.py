@@ -0,0 +1,320 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+
+import numpy as np
+import torch
+
+from utils.functions import auto_batch_size, per_thread_num_threads
+from utils.profiling import stage
+from utils.progress import report_slices
+
+# Defaults shared by every stage that runs a model slice by slice. They can be changed for the
+# whole process with configure(), or overridden per call through the keyword arguments of infer_slices().
+_OPTIONS = {
+    "batch_size": None,
+    "precision": "fp32",
+    "channels_last": False,
+    "prefetch": 2,
+    "parallel_views": False,
+    "skip_empty": False,
+}
+
+# Reduced-precision modes of the forward pass, run under autocast
+PRECISIONS = {
+    "fp32": None,
+    "bf16": torch.bfloat16,
+    "fp16": torch.float16,
+}
+
+
+def configure(**options):
+    """
+    Changes the default slice-inference options used by cropping, stripping, parcellation and hemisphere.
+
+    Args:
+        **options: Option names and values. Supported options:
+            - batch_size (int or None): The number of slices per forward pass. None chooses it automatically.
+            - precision (str): 'fp32' (default), 'bf16' or 'fp16'. The reduced precisions run the forward pass
+              under autocast (bf16 uses the native bf16 matrix units of recent CPUs, fp16 is meant for GPUs);
+              activations, fusion and argmax stay in float32.
+            - channels_last (bool): Whether to pass the input batches in channels_last (NHWC) memory format.
+              Use it with models converted by load_model with opt.channels_last, so that the CPU convolution
+              kernels run without converting the layout of every layer.
+            - prefetch (int): The number of input batches prepared ahead on a background thread, which also
+              stores the outputs while the next batch is computed. 0 runs everything on the calling thread.
+            - parallel_views (bool): Whether the independent views of a stage (coronal, sagittal, axial) run
+              concurrently, see run_views.
+            - skip_empty (bool): Whether slices whose input is entirely background skip the model and get the
+              background prediction instead, see infer_slices. Off by default, since it can change labels.
+
+    Returns:
+        dict: The options that were in effect before the call, which can be passed back to restore them.
+    """
+    unknown = set(options) - set(_OPTIONS)
+    if unknown:
+        raise ValueError("Unknown inference option(s): " + ", ".join(sorted(unknown)))
+    if options.get("precision", "fp32") not in PRECISIONS:
+        raise ValueError(f"Unknown precision: {options['precision']}")
+    previous = dict(_OPTIONS)
+    _OPTIONS.update(options)
+    return previous
+
+
+def get_option(name, value=None):
+    """
+    Returns the given value, or the configured default for the option if the value is None.
+    """
+    return _OPTIONS[name] if value is None else value
+
+
+def result_options():
+    """
+    Returns the configured options that can change the labels, for use in result cache keys.
+    """
+    return sorted((name, _OPTIONS[name]) for name in ("precision", "skip_empty"))
+
+
+def forward(model, image, precision=None):
+    """
+    Runs the model on a batch, under autocast if a reduced precision is configured.
+
+    Args:
+        model (torch.nn.Module): The model.
+        image (torch.Tensor): The input batch.
+        precision (str, optional): 'fp32', 'bf16' or 'fp16'. Defaults to the configured value.
+
+    Returns:
+        torch.Tensor: The float32 model output.
+    """
+    dtype = PRECISIONS[get_option("precision", precision)]
+    if dtype is None:
+        return model(image)
+    with torch.autocast(device_type=image.device.type, dtype=dtype):
+        return model(image).float()
+
+
+def activate(x, activation):
+    """
+    Applies the output activation of a model.
+
+    Args:
+        x (torch.Tensor): The raw model output of shape (N, C, H, W).
+        activation (str or None): 'sigmoid', 'softmax' (over the channel dimension) or None.
+
+    Returns:
+        torch.Tensor: The activated output.
+    """
+    if activation == "sigmoid":
+        return torch.sigmoid(x)
+    if activation == "softmax":
+        return torch.softmax(x, 1)
+    if activation is None:
+        return x
+    raise ValueError(f"Unknown activation: {activation}")
+
+
+def infer_slices(
+    voxel,
+    model,
+    device,
+    ch_out,
+    activation="softmax",
+    context=0,
+    output=None,
+    out_device=None,
+    batch_size=None,
+    accumulate=False,
+    precision=None,
+    channels_last=None,
+    prefetch=None,
+    lock=None,
+    skip_empty=None,
+):
+    """
+    Runs a 2D model over every slice of a volume and collects the outputs.
+
+    The first axis of the volume is the slice axis. With context > 0 the model input of each slice is the
+    stack of the 2 * context + 1 neighbouring slices (2.5D input), where the volume is padded along the
+    slice axis with its minimum value.
+
+    With skip_empty, the slices whose whole input window holds the volume minimum are not run through the
+    model. They get the prediction of the background instead: class 0 for softmax and 0 for sigmoid outputs.
+    In the masked volumes of stripping, parcellation and hemisphere these are the slices outside the bounding
+    box of the mask along the slice axis. The model output for such an input is not necessarily that
+    prediction, so the option is off by default and labels can differ from a run without it.
+
+    The slices done are reported to the active progress after every batch, which is also where a cancelled
+    run stops (see progress.track).
+
+    Args:
+        voxel (numpy.ndarray): The input volume of shape (S, H, W).
+        model (torch.nn.Module): The model applied to every slice.
+        device (torch.device): The device (CPU or GPU) on which the model is run.
+        ch_out (int): The number of output channels of the model.
+        activation (str or None): The activation applied to the model output ('sigmoid', 'softmax' or None).
+        context (int): The number of neighbouring slices stacked on each side of a slice as input channels.
+        output (torch.Tensor, optional): A preallocated tensor of shape (S, ch_out, H, W) to write into.
+            It may be a permuted view of a larger tensor, e.g. a fusion accumulator in another orientation.
+        out_device (torch.device, optional): The device of the allocated output. Defaults to the model device.
+        batch_size (int, optional): The number of slices per forward pass. Defaults to the configured value.
+        accumulate (bool): If True, the outputs are added to the given output tensor instead of replacing it.
+        precision (str, optional): The precision of the forward pass. Defaults to the configured value.
+        channels_last (bool, optional): Whether to pass the input in channels_last format. Defaults to the
+            configured value.
+        prefetch (int, optional): The number of batches prepared ahead. Defaults to the configured value.
+        lock (threading.Lock, optional): Held while the outputs are stored, for outputs that are views of a
+            tensor shared with concurrently running calls.
+        skip_empty (bool, optional): Whether to skip slices of pure background. Defaults to the configured
+            value. Ignored without an activation.
+
+    Returns:
+        torch.Tensor: The output tensor of shape (S, ch_out, H, W).
+    """
+    n_slices, height, width = voxel.shape
+    if accumulate and output is None:
+        raise ValueError("accumulate requires a preallocated output tensor")
+    ch_in = 2 * context + 1
+    device = torch.device(device)
+    memory_format = torch.channels_last if get_option("channels_last", channels_last) else torch.contiguous_format
+    prefetch = get_option("prefetch", prefetch)
+
+    batch_size = get_option("batch_size", batch_size)
+    if batch_size is None:
+        batch_size = auto_batch_size(device, ch_in, ch_out, height, width)
+
+    if context:
+        voxel = np.pad(voxel, [(context, context), (0, 0), (0, 0)], "constant", constant_values=voxel.min())
+
+    # Zero-copy view of shape (S, ch_in, H, W) whose slice s stacks the input slices s .. s + ch_in - 1
+    windows = np.lib.stride_tricks.sliding_window_view(voxel, ch_in, axis=0).transpose(0, 3, 1, 2)
+
+    # Find the slices with any foreground in their input window, and batch consecutive runs of them
+    if get_option("skip_empty", skip_empty) and activation is not None:
+        foreground = (voxel != voxel.min()).any(axis=(1, 2))
+        active = np.lib.stride_tricks.sliding_window_view(foreground, ch_in).any(axis=1)
+    else:
+        active = np.ones(n_slices, dtype=bool)
+    batches, empty = [], []
+    for run_start, run_stop, run_active in _runs(active):
+        if run_active:
+            batches.extend(
+                (start, min(start + batch_size, run_stop)) for start in range(run_start, run_stop, batch_size)
+            )
+        else:
+            empty.append((run_start, run_stop))
+
+    # Set the model to evaluation mode
+    model.eval()
+
+    # Disable gradient calculation for inference; input batches are prepared on the reader thread and
+    # outputs are stored on the writer thread, so that both overlap with the forward passes
+    with torch.inference_mode(), ThreadPoolExecutor(1) as reader, ThreadPoolExecutor(1) as writer:
+        if output is None:
+            output = torch.zeros(n_slices, ch_out, height, width, device=out_device or device)
+
+        for start, stop in empty:
+            _store_background(output, start, stop, activation, accumulate, lock)
+        done = sum(stop - start for start, stop in empty)
+        report_slices(done, n_slices)
+
+        pending = deque()
+        write = None
+        for i, (start, stop) in enumerate(batches):
+            # Keep the next prefetch batches in preparation
+            if prefetch:
+                for j in range(i + len(pending), min(i + prefetch + 1, len(batches))):
+                    pending.append(reader.submit(_prepare, windows, *batches[j], device, memory_format))
+                image = pending.popleft().result()
+            else:
+                image = _prepare(windows, start, stop, device, memory_format)
+
+            # Perform the forward pass through the model and apply the activation
+            x_out = activate(forward(model, image, precision), activation).detach()
+
+            # Store the outputs in the corresponding slices of the output tensor
+            if write is not None:
+                write.result()
+            if prefetch:
+                write = writer.submit(_store, output, start, stop, x_out, accumulate, lock)
+            else:
+                _store(output, start, stop, x_out, accumulate, lock)
+            done += stop - start
+            report_slices(done, n_slices)
+        if write is not None:
+            write.result()
+
+        return output
+
+
+def _runs(active):
+    # Splits the slice axis into runs of consecutive slices that are all active or all inactive
+    bounds = [0, *(np.flatnonzero(np.diff(active.astype(np.int8))) + 1).tolist(), len(active)]
+    return [(start, stop, bool(active[start])) for start, stop in zip(bounds[:-1], bounds[1:])]
+
+
+def _store_background(output, start, stop, activation, accumulate, lock=None):
+    # Stores the prediction of an empty input: all probability on class 0 for softmax, 0 for sigmoid
+    with torch.inference_mode(), lock or nullcontext():
+        if activation == "softmax":
+            if not accumulate:
+                output[start:stop] = 0
+            output[start:stop, 0] += 1
+        elif not accumulate:
+            output[start:stop] = 0
+
+
+def _prepare(windows, start, stop, device, memory_format):
+    # Copy the stacked input slices of a batch into a float32 tensor on the model device
+    image = torch.from_numpy(np.ascontiguousarray(windows[start:stop], dtype=np.float32))
+    if device.type == "cuda":
+        # Pinned memory lets the copy to the GPU run asynchronously
+        image = image.pin_memory().to(device, non_blocking=True)
+    else:
+        image = image.to(device)
+    return image.contiguous(memory_format=memory_format)
+
+
+def _store(output, start, stop, x_out, accumulate, lock=None):
+    # The output may be an inference tensor, which can only be modified in inference mode
+    with torch.inference_mode():
+        x_out = x_out.to(device=output.device, dtype=output.dtype)
+    with torch.inference_mode(), lock or nullcontext():
+        if accumulate:
+            output[start:stop] += x_out
+        else:
+            output[start:stop] = x_out
+
+
+def run_views(*views, parallel=None):
+    """
+    Runs the independent views of a stage and records each of them as a stage of the active run report.
+
+    With parallel_views, the views run concurrently in threads that share the intra-op threads of torch
+    equally, which keeps a many-core CPU busy where a single view does not scale. The views then hold their
+    inputs and outputs at the same time, so peak memory grows with the number of views. The share of threads
+    needs a thread count per thread, which functions.per_thread_num_threads probes at runtime; where the count
+    is process-wide the views run one after another.
+
+    Args:
+        *views: (name, slices, fn) tuples, where fn takes no arguments and returns the output of the view.
+        parallel (bool, optional): Whether to run the views concurrently. Defaults to the configured value.
+
+    Returns:
+        list: The outputs of the views, in order.
+    """
+
+    def run(name, slices, fn, threads=None):
+        if threads is not None:
+            torch.set_num_threads(threads)
+        with stage(name, slices=slices):
+            return fn()
+
+    if not get_option("parallel_views", parallel) or len(views) < 2 or not per_thread_num_threads():
+        return [run(*view) for view in views]
+
+    # Every worker thread sets its own count, so the count of the calling thread stays as it is
+    threads = torch.get_num_threads()
+    with ThreadPoolExecutor(len(views)) as executor:
+        futures = [executor.submit(run, *view, max(1, threads // len(views))) for view in views]
+        return [future.result() for future in futures]
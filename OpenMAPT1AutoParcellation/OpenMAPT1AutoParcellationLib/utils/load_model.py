@@ -1,11 +1,162 @@
+import gc
+import hashlib
 import os
+import threading
+from collections import OrderedDict
 
 import torch
 
+from utils.functions import available_memory
 from utils.network import UNet
+from utils.onnx_backend import OnnxModel
+from utils.quantization import QUANTIZED_FILES, load_quantized, quantized_path
+from utils.tracing import TracedModel
 
+# Checkpoint file, input channels and output channels of every model, in the order returned by load_model
+MODEL_FILES = (
+    ("CNet/CNet.pth", 1, 1),
+    ("SSNet/SSNet.pth", 1, 1),
+    ("PNet/coronal.pth", 3, 142),
+    ("PNet/sagittal.pth", 3, 142),
+    ("PNet/axial.pth", 3, 142),
+    ("HNet/coronal.pth", 1, 3),
+    ("HNet/axial.pth", 1, 3),
+)
 
-def load_model(opt, device):
+# Execution backends of the models, selected with opt.backend
+BACKENDS = ("torch", "onnx")
+
+# Process-wide cache of loaded models, most recently used last
+MAX_CACHED_MODEL_SETS = 2
+_model_cache = OrderedDict()
+_model_cache_lock = threading.RLock()
+_hash_cache = {}
+
+
+def file_fingerprint(path, content_hash=False):
+    """
+    Identifies a checkpoint file by its modification time and size, and optionally by its SHA-256 hash.
+
+    The hash is computed once per (path, mtime, size) and remembered for the rest of the process.
+
+    Args:
+        path (str): The path of the file.
+        content_hash (bool): Whether to include the SHA-256 hash of the file content.
+
+    Returns:
+        tuple: (mtime_ns, size) or (mtime_ns, size, sha256).
+    """
+    stat = os.stat(path)
+    fingerprint = (stat.st_mtime_ns, stat.st_size)
+    if not content_hash:
+        return fingerprint
+    key = (os.path.abspath(path),) + fingerprint
+    if key not in _hash_cache:
+        sha = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                sha.update(chunk)
+        _hash_cache[key] = sha.hexdigest()
+    return fingerprint + (_hash_cache[key],)
+
+
+def model_fingerprint(model_folder, content_hash=False):
+    """
+    Returns the fingerprints of all checkpoint files in a model folder.
+    """
+    return tuple(
+        (name, file_fingerprint(os.path.join(model_folder, name), content_hash)) for name, _, _ in MODEL_FILES
+    )
+
+
+def _build_options(opt):
+    # The options of opt that change how the models are built, as part of the model cache key
+    backend = getattr(opt, "backend", "torch")
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend: {backend}")
+    trace = getattr(opt, "trace", False)
+    if trace and backend != "torch":
+        raise ValueError("opt.trace is only supported with the torch backend")
+    int8 = getattr(opt, "int8", False)
+    if int8 and backend != "torch":
+        raise ValueError("opt.int8 is only supported with the torch backend")
+    fuse_bn = getattr(opt, "fuse_bn", True)
+    channels_last = getattr(opt, "channels_last", False)
+    return (
+        ("backend", backend),
+        ("trace", trace),
+        ("int8", int8),
+        ("fuse_bn", fuse_bn),
+        ("channels_last", channels_last),
+    )
+
+
+def _cache_key(opt, device):
+    model_folder = os.path.abspath(opt.m)
+    content_hash = getattr(opt, "content_hash", False)
+    return (
+        model_folder,
+        model_fingerprint(model_folder, content_hash),
+        str(torch.device(device)),
+        _build_options(opt),
+    )
+
+
+def _required_memory(model_folder):
+    return sum(os.path.getsize(os.path.join(model_folder, name)) for name, _, _ in MODEL_FILES)
+
+
+def _release():
+    # Collect the evicted models and return cached GPU blocks to the driver
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+def evict_models(model_folder=None, device=None):
+    """
+    Removes cached models from the process-wide cache and frees their memory.
+
+    Args:
+        model_folder (str, optional): Only evict the models loaded from this folder.
+        device (torch.device, optional): Only evict the models loaded on this device.
+
+    Returns:
+        int: The number of evicted model sets.
+    """
+    with _model_cache_lock:
+        keys = [
+            key
+            for key in _model_cache
+            if (model_folder is None or key[0] == os.path.abspath(model_folder))
+            and (device is None or key[2] == str(torch.device(device)))
+        ]
+        for key in keys:
+            del _model_cache[key]
+    if keys:
+        _release()
+    return len(keys)
+
+
+def clear_model_cache():
+    """
+    Removes all models from the process-wide cache and frees their memory.
+    """
+    return evict_models()
+
+
+def _make_room(model_folder, device):
+    # Unload the least recently used model sets while the device does not have room for another one
+    required = _required_memory(model_folder)
+    while _model_cache:
+        free = available_memory(device)
+        if free is None or free > required * 1.5:
+            break
+        _model_cache.popitem(last=False)
+        _release()
+
+
+def load_model(opt, device, cache=True):
     """
     This function loads multiple pre-trained models and sets them to evaluation mode.
     The models loaded are:
@@ -17,54 +168,100 @@ def load_model(opt, device):
     6. HNet coronal: A U-Net model for coronal plane predictions with different input/output channels.
     7. HNet axial: A U-Net model for axial plane predictions with different input/output channels.
 
+    Unless opt.fuse_bn is False, the BatchNorm layers are folded into the preceding convolutions after the
+    weights are loaded (see network.UNet.fuse), which gives the same outputs with less memory traffic.
+
+    If opt.channels_last is set, the weights are converted to channels_last (NHWC) memory format. Configure the
+    inference option of the same name (see inference.configure) so that the input batches match.
+
+    If opt.trace is set, every model runs as frozen TorchScript graphs traced for the input shapes it is
+    called with (see tracing.TracedModel). The traced graphs are stored in opt.trace_dir, by default the
+    "traced" subfolder of the model folder, so that only the first run after a model or torch update pays
+    the tracing cost.
+
+    If opt.backend is "onnx", every model is exported to ONNX for the input shapes it is called with and run
+    by the CPU execution provider of ONNX Runtime (see onnx_backend.OnnxModel), so the device must be the CPU.
+    Each export is checked against the PyTorch output before it is stored in opt.onnx_dir, by default the
+    "onnx" subfolder of the model folder.
+
+    If opt.int8 is set, the parcellation and hemisphere networks are replaced by the INT8 models created by
+    openmap_quantize.py, read from opt.int8_dir (by default the "int8" subfolder of the model folder). INT8
+    models run on the CPU only, and are rejected if they were calibrated from a different checkpoint.
+
+    Loaded models are kept in a process-wide cache keyed by the model folder, the modification time and size
+    (and, if opt.content_hash is set, the SHA-256 hash) of every checkpoint, the device, opt.backend,
+    opt.trace, opt.int8, opt.fuse_bn and opt.channels_last. Later calls with the same key return the cached
+    models without reading the checkpoints again. Changed checkpoints give a new key and unload the models of
+    the old checkpoints, and the least recently used model sets are unloaded when the device runs short of
+    memory.
+
     Parameters:
-    opt (object): An options object containing model paths.
+    opt (object): An options object containing the model folder (opt.m) and optionally content_hash, backend
+        ("torch" or "onnx"), fuse_bn, channels_last, trace, trace_dir, onnx_dir, int8 and int8_dir.
     device (torch.device): The device on which to load the models (CPU or GPU).
+    cache (bool): Whether to use the process-wide model cache.
 
     Returns:
     tuple: A tuple containing all the loaded models.
     """
-    # Load CNet model
-    cnet = UNet(1, 1)
-    cnet.load_state_dict(torch.load(os.path.join(opt.m, "CNet/CNet.pth"), weights_only=True))
-    cnet.to(device)
-    cnet.eval()
-
-    # Load SSNet model
-    ssnet = UNet(1, 1)
-    ssnet.load_state_dict(torch.load(os.path.join(opt.m, "SSNet/SSNet.pth"), weights_only=True))
-    ssnet.to(device)
-    ssnet.eval()
-
-    # Load PNet coronal model
-    pnet_c = UNet(3, 142)
-    pnet_c.load_state_dict(torch.load(os.path.join(opt.m, "PNet/coronal.pth"), weights_only=True))
-    pnet_c.to(device)
-    pnet_c.eval()
-
-    # Load PNet sagittal model
-    pnet_s = UNet(3, 142)
-    pnet_s.load_state_dict(torch.load(os.path.join(opt.m, "PNet/sagittal.pth"), weights_only=True))
-    pnet_s.to(device)
-    pnet_s.eval()
-
-    # Load PNet axial model
-    pnet_a = UNet(3, 142)
-    pnet_a.load_state_dict(torch.load(os.path.join(opt.m, "PNet/axial.pth"), weights_only=True))
-    pnet_a.to(device)
-    pnet_a.eval()
-
-    # Load HNet coronal model
-    hnet_c = UNet(1, 3)
-    hnet_c.load_state_dict(torch.load(os.path.join(opt.m, "HNet/coronal.pth"), weights_only=True))
-    hnet_c.to(device)
-    hnet_c.eval()
-
-    # Load HNet axial model
-    hnet_a = UNet(1, 3)
-    hnet_a.load_state_dict(torch.load(os.path.join(opt.m, "HNet/axial.pth"), weights_only=True))
-    hnet_a.to(device)
-    hnet_a.eval()
-
-    # Return all loaded models
-    return cnet, ssnet, pnet_c, pnet_s, pnet_a, hnet_c, hnet_a
+    if not cache:
+        _build_options(opt)
+        return _load_models(opt, device)
+
+    key = _cache_key(opt, device)
+    with _model_cache_lock:
+        if key in _model_cache:
+            _model_cache.move_to_end(key)
+            return _model_cache[key]
+
+        # Checkpoints that changed on disk replace the models previously loaded from the same folder; the other
+        # variants of the same checkpoints (backend, int8, ...) stay cached
+        stale = [k for k in _model_cache if k[0] == key[0] and k[2] == key[2] and k[1] != key[1]]
+        for k in stale:
+            del _model_cache[k]
+        if stale:
+            _release()
+        _make_room(opt.m, device)
+
+        models = _load_models(opt, device)
+        _model_cache[key] = models
+        while len(_model_cache) > MAX_CACHED_MODEL_SETS:
+            _model_cache.popitem(last=False)
+        return models
+
+
+def _load_models(opt, device):
+    model_folder = opt.m
+    trace_dir = getattr(opt, "trace_dir", None) or os.path.join(model_folder, "traced")
+    onnx_dir = getattr(opt, "onnx_dir", None) or os.path.join(model_folder, "onnx")
+    int8_dir = getattr(opt, "int8_dir", None) or os.path.join(model_folder, "int8")
+    backend = getattr(opt, "backend", "torch")
+    int8 = getattr(opt, "int8", False)
+    fuse_bn = getattr(opt, "fuse_bn", True)
+    memory_format = torch.channels_last if getattr(opt, "channels_last", False) else torch.contiguous_format
+    content_hash = getattr(opt, "content_hash", False)
+    if int8 and torch.device(device).type != "cpu":
+        raise ValueError("INT8 models run on the CPU only")
+    if backend == "onnx" and torch.device(device).type != "cpu":
+        raise ValueError("The ONNX backend runs on the CPU only")
+    models = []
+    for name, ch_in, ch_out in MODEL_FILES:
+        path = os.path.join(model_folder, name)
+        if int8 and name in QUANTIZED_FILES:
+            models.append(load_quantized(quantized_path(int8_dir, name), file_fingerprint(path, content_hash=True)[2]))
+            continue
+        model = UNet(ch_in, ch_out)
+        model.load_state_dict(torch.load(path, weights_only=True))
+        model.eval()
+        if fuse_bn:
+            model.fuse()
+        model.set_memory_format(memory_format).to(device)
+        fingerprint = (name, file_fingerprint(path, content_hash), fuse_bn, memory_format == torch.channels_last)
+        if backend == "onnx":
+            model = OnnxModel(model, onnx_dir, fingerprint)
+        elif getattr(opt, "trace", False):
+            model = TracedModel(model, trace_dir, fingerprint)
+        models.append(model)
+
+    # Return all loaded models: cnet, ssnet, pnet_c, pnet_s, pnet_a, hnet_c, hnet_a
+    return tuple(models)
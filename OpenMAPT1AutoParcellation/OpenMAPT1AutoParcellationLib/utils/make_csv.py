@@ -1,11 +1,117 @@
 import os
 from collections import defaultdict
+from functools import lru_cache
 
 import numpy as np
 import pandas as pd
 
+# The levels derived from Type1_Level5, in the order the CSV files are written
+LEVELS = (
+    "Type1_Level4",
+    "Type1_Level3",
+    "Type1_Level2",
+    "Type1_Level1",
+    "Type2_Level5",
+    "Type2_Level4",
+    "Type2_Level3",
+    "Type2_Level2",
+    "Type2_Level1",
+)
 
-def change_level(df, level="Type1_Level1", sulcus=True):
+# The tables that make_csv reads from the level directory
+LEVEL_FILES = ("Level5.txt", "Level_ROI_No.csv", "Level_ROI_Name.csv")
+
+
+def missing_level_tables(level_dir="level"):
+    """
+    Returns the names of the level tables that make_csv needs and that are missing from level_dir.
+    """
+    return [name for name in LEVEL_FILES if not os.path.isfile(os.path.join(level_dir, name))]
+
+
+@lru_cache(maxsize=None)
+def read_level_tables(level_dir="level", sulcus=True):
+    """
+    Reads the ROI number and name tables of the given level directory once per process.
+
+    Returns:
+        tuple: (ROI_number, ROI_name) DataFrames, without the sulcus regions if sulcus is False.
+    """
+    ROI_number = pd.read_csv(os.path.join(level_dir, "Level_ROI_No.csv"))
+    ROI_name = pd.read_csv(os.path.join(level_dir, "Level_ROI_Name.csv"))
+
+    if sulcus == False:
+        tmp = ROI_number["Type1_Level2"]
+        ROI_number = ROI_number[tmp != 18]
+        ROI_number = ROI_number[tmp != 19]
+        ROI_name = ROI_name[tmp != 18]
+        ROI_name = ROI_name[tmp != 19]
+    return ROI_number, ROI_name
+
+
+@lru_cache(maxsize=None)
+def aggregation_matrix(levels, sulcus=True, level_dir="level"):
+    """
+    Builds the matrix that sums Type1_Level5 ROI volumes into the regions of one or more levels.
+
+    Parameters:
+    levels (tuple of str): The levels to aggregate to.
+    sulcus (bool): A flag indicating whether to include sulcus regions. Default is True.
+    level_dir (str): The directory containing the ROI level tables. Default is "level".
+
+    Returns:
+    tuple: A tuple containing:
+        - rois (list of str): The Type1_Level5 ROIs, i.e. the rows of the matrix.
+        - names (list of list of str): The region names of every level.
+        - matrix (numpy.ndarray): A 0/1 matrix of shape (len(rois), total number of regions), with the
+          columns of the levels side by side in the given order.
+    """
+    ROI_number, ROI_name = read_level_tables(level_dir, sulcus)
+    rois = list(dict.fromkeys(ROI_number["ROI"]))
+    row = {roi: i for i, roi in enumerate(rois)}
+
+    names, columns = [], []
+    for level in levels:
+        data = dict(zip(ROI_number["ROI"], ROI_number[level]))
+        level_dict = defaultdict(list)
+        for key, value in data.items():
+            level_dict[str(value)].append(key)
+        level_names = ROI_name[level].unique()
+        names.append([level_names[i] for i in range(len(level_dict))])
+        columns.extend(level_dict.values())
+
+    matrix = np.zeros((len(rois), len(columns)))
+    for j, members in enumerate(columns):
+        matrix[[row[key] for key in members], j] = 1
+    matrix.setflags(write=False)
+    return rois, names, matrix
+
+
+def aggregate_levels(df, levels=LEVELS, sulcus=True, level_dir="level"):
+    """
+    Changes the level of the given DataFrame to several ROI levels with a single matrix product.
+
+    Parameters:
+    df (pd.DataFrame): The Type1_Level5 DataFrame, one row per subject and one column per ROI.
+    levels (tuple of str): The levels to compute. Default is all levels derived from Type1_Level5.
+    sulcus (bool): A flag indicating whether to include sulcus regions. Default is True.
+    level_dir (str): The directory containing the ROI level tables. Default is "level".
+
+    Returns:
+    dict: The DataFrame of every level, keyed by level name.
+    """
+    rois, names, matrix = aggregation_matrix(tuple(levels), sulcus, os.path.abspath(level_dir))
+    volumes = np.nan_to_num(df[rois].to_numpy(dtype="float64")) @ matrix
+
+    changed, start = {}, 0
+    for level, level_names in zip(levels, names):
+        stop = start + len(level_names)
+        changed[level] = pd.DataFrame(volumes[:, start:stop], index=df.index, columns=level_names)
+        start = stop
+    return changed
+
+
+def change_level(df, level="Type1_Level1", sulcus=True, level_dir="level"):
     """
     Change the level of the given DataFrame based on specified ROI levels.
 
@@ -13,6 +119,7 @@ def change_level(df, level="Type1_Level1", sulcus=True):
     df (pd.DataFrame): The input DataFrame to be modified.
     level (str): The level to which the DataFrame should be changed. Default is "Type1_Level1".
     sulcus (bool): A flag indicating whether to include sulcus regions. Default is True.
+    level_dir (str): The directory containing the ROI level tables. Default is "level".
 
     Returns:
     pd.DataFrame: The modified DataFrame with the specified level changes applied.
@@ -22,80 +129,74 @@ def change_level(df, level="Type1_Level1", sulcus=True):
     - If sulcus is set to False, regions with Type1_Level2 values of 18 and 19 are excluded.
     - The function creates a dictionary mapping ROI numbers to the specified level and aggregates the DataFrame accordingly.
     """
-    ROI_number = pd.read_csv("level/Level_ROI_No.csv")
-    ROI_name = pd.read_csv("level/Level_ROI_Name.csv")
+    return aggregate_levels(df, (level,), sulcus, level_dir)[level]
 
-    if sulcus == False:
-        tmp = ROI_number["Type1_Level2"]
-        ROI_number = ROI_number[tmp != 18]
-        ROI_number = ROI_number[tmp != 19]
-        ROI_name = ROI_name[tmp != 18]
-        ROI_name = ROI_name[tmp != 19]
-    data = dict(zip(ROI_number["ROI"], ROI_number[level]))
-    level_dict = defaultdict(list)
-    for key, value in data.items():
-        level_dict[str(value)].append(key)
 
-    change_df_list = []
-    for i, (key, value) in enumerate(level_dict.items()):
-        name = ROI_name[level].unique()[i]
-        change_df_list.append(df[value].sum(axis=1).rename(name))
+@lru_cache(maxsize=None)
+def read_level5(level_dir="level"):
+    """
+    Reads the label numbers and region names of Type1_Level5 once per process.
 
-    change_df = pd.concat(change_df_list, axis=1)
-    return change_df
+    Returns:
+    tuple: (numbers, regions) with the integer label of every region and the region names.
+    """
+    table = pd.read_table(os.path.join(level_dir, "Level5.txt"), names=["number", "region"]).astype("str")
+    return table["number"].astype(int).to_numpy(), table["region"].tolist()
 
 
-def make_csv(parcellation, output_dir, basename):
+def count_labels(parcellation, n_labels=281):
+    """
+    Counts the voxels of every label with one bincount pass per subject.
+
+    Parameters:
+    parcellation (numpy.ndarray): A labelmap, or a stack of labelmaps with the subjects along the first axis.
+    n_labels (int): The number of labels to count, starting at 0.
+
+    Returns:
+    numpy.ndarray: The counts of shape (n_labels,), or (n_subjects, n_labels) for a stack.
+    """
+    parcellation = np.asarray(parcellation)
+    if parcellation.ndim == 4:
+        return np.stack([count_labels(p, n_labels) for p in parcellation])
+    return np.bincount(parcellation.ravel(), minlength=n_labels)[:n_labels]
+
+
+def make_csv(parcellation, output_dir, basename, level_dir="level", uids=None):
     """
     Generates multiple CSV files containing volume data for different levels of parcellation.
 
     Parameters:
     parcellation (numpy.ndarray): The parcellation data array where each unique integer represents a different region.
+        A 4-D array is treated as a stack of subjects along the first axis, giving one row per subject.
     output_dir (str): The directory where the output CSV files will be saved.
     basename (str): The base name for the output CSV files.
+    level_dir (str): The directory containing Level5.txt and the ROI level tables. Default is "level".
+    uids (list of str, optional): The row names of a stack of subjects. Default is the basename for a single
+        subject and "<basename>_<index>" for a stack.
 
     Returns:
     pandas.DataFrame: The DataFrame containing volume data for Type1_Level5.
 
     The function performs the following steps:
-    1. Reads a predefined text file containing region information and creates a DataFrame.
-    2. Calculates the volume for each region in the parcellation data.
-    3. Updates the DataFrame with the calculated volumes.
-    4. Changes the level of the DataFrame to different hierarchical levels (Type1_Level4, Type1_Level3, etc.).
+    1. Reads a predefined text file containing region information (once per process).
+    2. Counts the voxels of all regions in a single bincount pass.
+    3. Builds the Type1_Level5 DataFrame from the counts.
+    4. Changes the level of the DataFrame to all other levels (Type1_Level4, ..., Type2_Level1) with one matrix product.
     5. Saves the DataFrames for each level to separate CSV files in the specified output directory.
     """
-    csv_path = "level/Level5.txt"
-    df_Type1_level5 = (
-        pd.read_table(csv_path, names=["number", "region"]).astype("str").set_index("number")
-    )
-    for i in range(1, 281):
-        volume = np.count_nonzero(parcellation == i)
-        df_Type1_level5.loc[str(i), basename] = volume
-
-    df_Type1_level5 = (
-        df_Type1_level5.set_index("region").T.reset_index().rename(columns={"index": "uid"})
-    )
-    df_Type1_level4 = change_level(df_Type1_level5, level="Type1_Level4")
-    df_Type1_level3 = change_level(df_Type1_level5, level="Type1_Level3")
-    df_Type1_level2 = change_level(df_Type1_level5, level="Type1_Level2")
-    df_Type1_level1 = change_level(df_Type1_level5, level="Type1_Level1")
-
-    df_Type2_level5 = change_level(df_Type1_level5, level="Type2_Level5")
-    df_Type2_level4 = change_level(df_Type1_level5, level="Type2_Level4")
-    df_Type2_level3 = change_level(df_Type1_level5, level="Type2_Level3")
-    df_Type2_level2 = change_level(df_Type1_level5, level="Type2_Level2")
-    df_Type2_level1 = change_level(df_Type1_level5, level="Type2_Level1")
+    numbers, regions = read_level5(os.path.abspath(level_dir))
+    counts = count_labels(parcellation, max(281, numbers.max() + 1))
+    counts = np.atleast_2d(counts)
+    if uids is None:
+        uids = [basename] if len(counts) == 1 else [f"{basename}_{i}" for i in range(len(counts))]
+
+    df_Type1_level5 = pd.DataFrame(counts[:, numbers].astype("float64"), columns=pd.Index(regions, name="region"))
+    df_Type1_level5.insert(0, "uid", uids)
+
+    levels = aggregate_levels(df_Type1_level5, LEVELS, level_dir=level_dir)
 
     df_Type1_level5.to_csv(os.path.join(output_dir, f"{basename}_Type1_Level5.csv"), index=False)
-    df_Type1_level4.to_csv(os.path.join(output_dir, f"{basename}_Type1_Level4.csv"), index=False)
-    df_Type1_level3.to_csv(os.path.join(output_dir, f"{basename}_Type1_Level3.csv"), index=False)
-    df_Type1_level2.to_csv(os.path.join(output_dir, f"{basename}_Type1_Level2.csv"), index=False)
-    df_Type1_level1.to_csv(os.path.join(output_dir, f"{basename}_Type1_Level1.csv"), index=False)
-
-    df_Type2_level5.to_csv(os.path.join(output_dir, f"{basename}_Type2_Level5.csv"), index=False)
-    df_Type2_level4.to_csv(os.path.join(output_dir, f"{basename}_Type2_Level4.csv"), index=False)
-    df_Type2_level3.to_csv(os.path.join(output_dir, f"{basename}_Type2_Level3.csv"), index=False)
-    df_Type2_level2.to_csv(os.path.join(output_dir, f"{basename}_Type2_Level2.csv"), index=False)
-    df_Type2_level1.to_csv(os.path.join(output_dir, f"{basename}_Type2_Level1.csv"), index=False)
+    for level in LEVELS:
+        levels[level].to_csv(os.path.join(output_dir, f"{basename}_{level}.csv"), index=False)
 
     return df_Type1_level5
@@ -0,0 +1,122 @@
+import os
+import threading
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from utils.functions import atomic_path, content_hash
+
+try:
+    import onnxruntime as ort
+except ImportError:
+    ort = None
+
+OPSET_VERSION = 17
+
+# Largest difference of the model outputs (logits) accepted between ONNX Runtime and PyTorch
+PARITY_TOLERANCE = 1e-3
+
+
+def parity(model, onnx_model, x):
+    """
+    Compares the outputs of a PyTorch model and its ONNX Runtime counterpart on a batch.
+
+    Args:
+        model (torch.nn.Module): The PyTorch model.
+        onnx_model (OnnxModel): The ONNX Runtime model.
+        x (torch.Tensor): The input batch.
+
+    Returns:
+        float: The largest absolute difference of the outputs.
+    """
+    with torch.no_grad():
+        expected = model(x).float().cpu()
+    return float((onnx_model(x).cpu() - expected).abs().max())
+
+
+class OnnxModel(nn.Module):
+    """
+    Runs a model through the CPU execution provider of ONNX Runtime, with the calling interface of the model.
+
+    The first call with a new input shape (channels, height, width) exports the model to ONNX for exactly
+    that shape, with a dynamic batch axis, and checks the ONNX Runtime output against PyTorch on the same
+    batch. The exported files are saved to the cache directory under a key of the checkpoint fingerprint,
+    the input shape, the torch version and the opset, so later processes only create the session.
+
+    The model must be on the CPU, where it is exported and checked; load_model rejects other devices for
+    this backend. The precision option does not apply; ONNX Runtime runs in float32.
+
+    Args:
+        model (torch.nn.Module): The model in evaluation mode.
+        cache_dir (str): The directory of the exported models.
+        fingerprint: A value identifying the model weights, e.g. load_model.file_fingerprint of the checkpoint.
+        threads (int, optional): The intra-op threads of ONNX Runtime. Defaults to torch.get_num_threads().
+    """
+
+    def __init__(self, model, cache_dir, fingerprint=None, threads=None):
+        super().__init__()
+        if ort is None:
+            raise ImportError("The ONNX backend requires the onnxruntime package (pip install onnxruntime)")
+        self.model = model.eval()
+        self.cache_dir = cache_dir
+        self.fingerprint = fingerprint
+        self.threads = threads
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def _path(self, shape):
+        key = content_hash(self.fingerprint, shape, torch.__version__, OPSET_VERSION)
+        return os.path.join(self.cache_dir, key + ".onnx")
+
+    def _export(self, x, path):
+        # Export outside inference mode, since inference tensors cannot be recorded into a graph
+        with torch.inference_mode(False), torch.no_grad():
+            torch.onnx.export(
+                self.model,
+                x[:1].detach().cpu().clone(),
+                path,
+                input_names=["image"],
+                output_names=["output"],
+                dynamic_axes={"image": {0: "batch"}, "output": {0: "batch"}},
+                opset_version=OPSET_VERSION,
+            )
+
+    def _create_session(self, path):
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.intra_op_num_threads = self.threads or torch.get_num_threads()
+        options.inter_op_num_threads = 1
+        return ort.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+
+    def session(self, x):
+        """
+        Returns the ONNX Runtime session for the shape of the batch x, exporting the model on first use.
+        """
+        shape = tuple(x.shape[1:])
+        if shape in self._sessions:
+            return self._sessions[shape]
+        with self._lock:
+            if shape in self._sessions:
+                return self._sessions[shape]
+            path = self._path(shape)
+            if os.path.exists(path):
+                self._sessions[shape] = self._create_session(path)
+            else:
+                # Only models that pass the parity check are stored under their final name
+                with atomic_path(path) as tmp_path:
+                    self._export(x, tmp_path)
+                    self._sessions[shape] = self._create_session(tmp_path)
+                    difference = parity(self.model, self, x)
+                    if difference > PARITY_TOLERANCE:
+                        del self._sessions[shape]
+                        raise RuntimeError(
+                            f"ONNX Runtime output differs from PyTorch by {difference:.2e} for input shape {shape}"
+                        )
+            return self._sessions[shape]
+
+    def forward(self, x):
+        session = self.session(x)
+        image = np.ascontiguousarray(x.detach().cpu().numpy(), dtype=np.float32)
+        (output,) = session.run(["output"], {"image": image})
+        return torch.from_numpy(output).to(x.device)
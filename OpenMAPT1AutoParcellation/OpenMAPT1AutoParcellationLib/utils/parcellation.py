@@ -1,10 +1,12 @@
-import numpy as np
+import threading
+
 import torch
 
-from utils.functions import normalize
+from utils.functions import as_normalized, available_memory, batch_memory
+from utils.inference import infer_slices, run_views
 
 
-def parcellate(voxel, model, device, mode):
+def parcellate(voxel, model, device, mode, batch_size=None, accumulator=None, lock=None):
     """
     Parcellates a given voxel volume using a specified model and mode.
 
@@ -12,89 +14,170 @@ def parcellate(voxel, model, device, mode):
         voxel (numpy.ndarray): The input voxel volume to be parcellated.
         model (torch.nn.Module): The neural network model used for parcellation.
         device (torch.device): The device (CPU or GPU) on which the model is run.
-        mode (str): The mode of parcellation. Can be 'c', 's', or 'a', which determines the stack dimensions.
+        mode (str): The view of the volume, 'c', 's' or 'a'. The stack dimensions follow the shape of the volume.
+        batch_size (int, optional): The number of consecutive 3-slice stacks sent through the model in one
+            forward pass. Defaults to the configured value.
+        accumulator (torch.Tensor, optional): A view of shape (stack[0], 142, stack[1], stack[2]) into a fusion
+            accumulator. If given, the softmax output is added to it instead of being stored in a new box.
+        lock (threading.Lock, optional): Held while adding into the accumulator, if views run concurrently.
 
     Returns:
-        torch.Tensor: The parcellated voxel volume.
+        torch.Tensor: The parcellated voxel volume, or the accumulator view if one was given.
     """
-    if mode == "c":
-        stack = (224, 192, 192)
-    elif mode == "s":
-        stack = (192, 224, 192)
-    elif mode == "a":
-        stack = (192, 224, 192)
-
-    # Set the model to evaluation mode
-    model.eval()
-
-    # Pad the voxel volume to handle edge cases
-    voxel = np.pad(voxel, [(1, 1), (0, 0), (0, 0)], "constant", constant_values=voxel.min())
+    stack = voxel.shape
+    if mode not in ("c", "s", "a"):
+        raise ValueError(f"Unknown parcellation mode: {mode}")
 
-    # Disable gradient calculation for inference
-    with torch.inference_mode():
-        # Initialize an empty tensor to store the parcellation results
-        box = torch.zeros(stack[0], 142, stack[1], stack[2])
+    if accumulator is not None:
+        # Add the softmax output of stacks of three consecutive slices straight into the accumulator
+        return infer_slices(
+            voxel, model, device, 142, activation="softmax", context=1, output=accumulator,
+            batch_size=batch_size, accumulate=True, lock=lock,
+        )
 
-        # Iterate over each slice in the stack dimension
-        for i in range(1, stack[0] + 1):
-            # Stack three consecutive slices to form the input image
-            image = np.stack([voxel[i - 1], voxel[i], voxel[i + 1]])
-            image = torch.tensor(image.reshape(1, 3, stack[1], stack[2]))
-            image = image.to(device)
+    # Run the model on stacks of three consecutive slices and apply softmax, collecting the results on the CPU
+    box = infer_slices(
+        voxel, model, device, 142, activation="softmax", context=1, out_device="cpu", batch_size=batch_size
+    )
 
-            # Perform the forward pass through the model and apply softmax
-            x_out = torch.softmax(model(image), 1).detach().cpu()
+    # Reshape the box tensor to the desired output shape
+    return box.reshape(stack[0], 142, stack[1], stack[2])
 
-            # Store the output in the corresponding slice of the box tensor
-            box[i - 1] = x_out
 
-        # Reshape the box tensor to the desired output shape
-        return box.reshape(stack[0], 142, stack[1], stack[2])
-
-
-def parcellation(voxel, pnet_c, pnet_s, pnet_a, device):
+def parcellation(
+    voxel, pnet_c, pnet_s, pnet_a, device, batch_size=None, fusion="stream", fusion_dtype=torch.float32, out_device=None
+):
     """
     Perform parcellation on the given voxel data using provided neural networks for coronal, sagittal, and axial views.
 
+    With fusion="stream" (the default) the softmax output of every view is added slice by slice into a single
+    (142, 192, 224, 192) accumulator, so peak memory is about one accumulator. The accumulator is kept on the
+    model device if it fits there next to the forward passes, and on the CPU otherwise, so a GPU does not need
+    the 4.7 GB of a float32 accumulator. With fusion="box" each view is first collected into its own float32
+    box on the CPU and the boxes are summed afterwards. With the parallel_views inference option the views run
+    concurrently (see inference.run_views); the streaming views then add into the accumulator under a lock.
+
+    With the views run one after another, a float32 accumulator adds them in the same order as the box fusion,
+    so both fusions give the same labels. With parallel_views the order of the additions varies between runs;
+    the sums then differ by float32 rounding (about 1e-7 relative), which can only flip voxels whose two most
+    likely parcels are that close, and labels are not guaranteed to be reproducible bit for bit. The opt-in
+    skip_empty option gives the slices of pure background the background class instead of the model prediction
+    for an empty input, so labels can differ from a run without it where a model predicts a parcel there; it is
+    part of the result cache key (see inference.result_options).
+
+    A float16 accumulator halves the memory; its rounding error is below 2e-3 on the summed probabilities (at
+    most 3), so labels can only change where the two most likely parcels are closer than that, typically well
+    under 0.1% of the voxels. bfloat16 halves the memory as well but its error bound is about 1.6e-2, so more
+    ties flip.
+
     Args:
-        voxel (torch.Tensor): The input 3D voxel data to be parcellated.
+        voxel (numpy.ndarray or NormalizedVolume): The stripped volume, or its normalisation shared with
+            hemisphere.
         pnet_c (torch.nn.Module): The neural network model for coronal view parcellation.
         pnet_s (torch.nn.Module): The neural network model for sagittal view parcellation.
         pnet_a (torch.nn.Module): The neural network model for axial view parcellation.
         device (torch.device): The device (CPU or GPU) to perform computations on.
+        batch_size (int, optional): The number of slices per forward pass. If None, it is chosen automatically.
+        fusion (str): The view fusion mode, either 'stream' or 'box'.
+        fusion_dtype (torch.dtype): The dtype of the streaming accumulator (float32, float16 or bfloat16).
+        out_device (torch.device, optional): The device of the streaming accumulator. Defaults to the model
+            device if the accumulator fits in its free memory, and to the CPU otherwise.
 
     Returns:
         numpy.ndarray: The parcellated output as a numpy array.
     """
-    # Normalize the voxel data
-    voxel = normalize(voxel)
+    # Normalize the voxel data, unless it was normalized already
+    voxel = as_normalized(voxel)
 
     # Prepare the voxel data for different views
     coronal = voxel.transpose(1, 2, 0)
     sagittal = voxel
     axial = voxel.transpose(2, 1, 0)
 
-    # Perform parcellation for the coronal view
-    out_c = parcellate(coronal, pnet_c, device, "c").permute(1, 3, 0, 2)
-    torch.cuda.empty_cache()
+    if fusion == "box":
+        out_e = fuse_boxes(coronal, sagittal, axial, pnet_c, pnet_s, pnet_a, device, batch_size)
+    elif fusion == "stream":
+        shape = (142, *voxel.shape)
+        if out_device is None:
+            out_device = accumulator_device(device, shape, fusion_dtype)
+        out_e = torch.zeros(shape, dtype=fusion_dtype, device=out_device)
+        lock = threading.Lock()
+
+        def accumulate(view, model, mode, accumulator):
+            parcellate(view, model, device, mode, batch_size, accumulator=accumulator, lock=lock)
+            torch.cuda.empty_cache()
+
+        # Add each view into the accumulator through the inverse of its output permutation
+        coronal_out = out_e.permute(2, 0, 3, 1)
+        sagittal_out = out_e.permute(1, 0, 2, 3)
+        axial_out = out_e.permute(3, 0, 2, 1)
+        run_views(
+            ("parcellation.coronal", len(coronal), lambda: accumulate(coronal, pnet_c, "c", coronal_out)),
+            ("parcellation.sagittal", len(sagittal), lambda: accumulate(sagittal, pnet_s, "s", sagittal_out)),
+            ("parcellation.axial", len(axial), lambda: accumulate(axial, pnet_a, "a", axial_out)),
+        )
+    else:
+        raise ValueError(f"Unknown fusion mode: {fusion}")
+
+    # Get the final parcellated output by taking the argmax
+    parcellated = torch.argmax(out_e, 0).cpu().numpy()
+
+    return parcellated
+
+
+def accumulator_device(device, shape, dtype=torch.float32):
+    """
+    Chooses the device of the streaming fusion accumulator.
+
+    On a GPU the accumulator stays on the device only if it fits in the free memory next to the forward
+    passes of the three views; otherwise it is kept on the CPU, as the boxes of the box fusion are.
+
+    Args:
+        device (torch.device): The device on which the models are run.
+        shape (tuple of int): The shape of the accumulator, (142, S, H, W).
+        dtype (torch.dtype): The dtype of the accumulator.
 
-    # Perform parcellation for the sagittal view
-    out_s = parcellate(sagittal, pnet_s, device, "s").permute(1, 0, 2, 3)
-    torch.cuda.empty_cache()
+    Returns:
+        torch.device: The device of the accumulator.
+    """
+    device = torch.device(device)
+    if device.type != "cuda":
+        return device
+    size = torch.tensor([], dtype=dtype).element_size()
+    for dim in shape:
+        size *= dim
+    needed = size + 3 * batch_memory(device, 3, shape[0], *shape[2:])
+    free = available_memory(device)
+    return device if free is not None and needed <= free else torch.device("cpu")
+
+
+def fuse_boxes(coronal, sagittal, axial, pnet_c, pnet_s, pnet_a, device, batch_size=None):
+    """
+    Sums the per-view probability boxes of the coronal, sagittal and axial views on the CPU.
 
-    # Combine the results from coronal and sagittal views
+    Returns:
+        torch.Tensor: The summed probabilities of shape (142, *sagittal.shape).
+    """
+    def box(view, model, mode, permutation):
+        out = parcellate(view, model, device, mode, batch_size).permute(*permutation)
+        torch.cuda.empty_cache()
+        return out
+
+    # Perform parcellation for the coronal and sagittal views
+    out_c, out_s = run_views(
+        ("parcellation.coronal", len(coronal), lambda: box(coronal, pnet_c, "c", (1, 3, 0, 2))),
+        ("parcellation.sagittal", len(sagittal), lambda: box(sagittal, pnet_s, "s", (1, 0, 2, 3))),
+    )
+
+    # Combine the results from coronal and sagittal views before the axial box is allocated
     out_e = out_c + out_s
     del out_c, out_s
 
     # Perform parcellation for the axial view
-    out_a = parcellate(axial, pnet_a, device, "a").permute(1, 3, 2, 0)
-    torch.cuda.empty_cache()
+    (out_a,) = run_views(("parcellation.axial", len(axial), lambda: box(axial, pnet_a, "a", (1, 3, 2, 0))))
 
     # Combine the results from all views
     out_e = out_e + out_a
     del out_a
 
-    # Get the final parcellated output by taking the argmax
-    parcellated = torch.argmax(out_e, 0).numpy()
-
-    return parcellated
+    return out_e
@@ -0,0 +1,243 @@
+import os
+
+import nibabel as nib
+import numpy as np
+import torch
+
+from utils.cropping import cropping
+from utils.functions import NormalizedVolume, available_memory, batch_memory, per_thread_num_threads
+from utils.hemisphere import hemisphere
+from utils.inference import get_option
+from utils.make_csv import make_csv
+from utils.parcellation import parcellation
+from utils.postprocessing import postprocessing
+from utils.preprocessing import n4_cache_settings, n4_settings, preprocessing, read_image
+from utils.profiling import run_report
+from utils.scheduler import Task, run_graph
+from utils.stripping import stripping
+
+# Output memory of the stages that can run concurrently, for the memory budget of the scheduler: the
+# (142, 192, 224, 192) float32 fusion accumulator and the two 3-channel hemisphere outputs. The forward
+# passes come on top, see _stage_memory
+PARCELLATION_MEMORY = 142 * 192 * 224 * 192 * 4
+HEMISPHERE_MEMORY = 2 * 3 * 192 * 224 * 192 * 4
+
+# Rough relative run times of the stages of run_inference on a CPU, for the overall fraction of a
+# progress.Progress; parcellation dominates with its 142-channel outputs
+PROGRESS_WEIGHTS = {
+    "preprocessing": 10,
+    "cropping.coronal": 2,
+    "cropping.sagittal": 2,
+    "stripping.coronal": 2,
+    "stripping.sagittal": 2,
+    "stripping.axial": 2,
+    "normalization": 1,
+    "parcellation.coronal": 20,
+    "parcellation.sagittal": 20,
+    "parcellation.axial": 20,
+    "hemisphere.coronal": 3,
+    "hemisphere.axial": 3,
+    "postprocessing": 4,
+}
+
+
+def _stage_memory(outputs, device, ch_in, ch_out, views):
+    # The outputs plus the forward passes of the views that run at the same time, each with the batch that
+    # auto_batch_size sizes from the free memory; the largest slice of the stripped volume is 224 x 192
+    concurrent = views if get_option("parallel_views") and per_thread_num_threads() else 1
+    return outputs + concurrent * batch_memory(device, ch_in, ch_out, 224, 192)
+
+
+def run_inference(
+    ipath,
+    output_dir,
+    basename,
+    models,
+    device,
+    log=None,
+    save_intermediates=False,
+    n4_profile=None,
+    n4_cache_dir=None,
+    n4_cache_bytes=None,
+):
+    """
+    Runs the OpenMAP-T1 stages from preprocessing to postprocessing on one T1 volume.
+
+    The stages form a dependency graph (see scheduler.run_graph). Parcellation and hemisphere separation
+    both depend only on the stripped volume, which is normalised once for both, so they run concurrently, with
+    three quarters and one quarter of the torch threads, when the device has memory for both and the torch
+    thread count is per thread (see functions.per_thread_num_threads).
+
+    Args:
+        ipath (str or SimpleITK.Image): The path of the input T1 image, or the image in memory.
+        output_dir (str): The directory for intermediate files.
+        basename (str): The base name for the output files.
+        models (tuple): The models returned by load_model.
+        device (torch.device): The device (CPU or GPU) on which the models are run.
+        log (callable, optional): Called with a short message before every stage.
+        save_intermediates (bool): Whether to also write intermediate images to the output directory.
+        n4_profile (str or dict, optional): The N4 bias-field correction profile, see preprocessing.n4_settings.
+        n4_cache_dir (str, optional): The directory of the bias-corrected image cache.
+        n4_cache_bytes (int, optional): The size limit of that cache, see preprocessing.N4_CACHE_BYTES.
+
+    Returns:
+        tuple: A tuple containing:
+            - data (nibabel.Nifti1Image): The conformed input image.
+            - aligned_output (numpy.ndarray): The labelmap in the space of the conformed image.
+    """
+    log = log or (lambda message: None)
+    cnet, ssnet, pnet_c, pnet_s, pnet_a, hnet_c, hnet_a = models
+    threads = torch.get_num_threads()
+    parcellation_threads = max(1, threads * 3 // 4)
+
+    tasks = [
+        Task(
+            "preprocessing",
+            lambda: preprocessing(
+                ipath, output_dir, basename, save_intermediates, n4_profile, n4_cache_dir, n4_cache_bytes
+            )[1],
+            message="Preprocessing...",
+        ),
+        Task("cropping", lambda data: cropping(data, cnet, device), ("preprocessing",), message="Cropping..."),
+        Task(
+            "stripping",
+            lambda data, cropped: stripping(cropped, data, ssnet, device),
+            ("preprocessing", "cropping"),
+            message="Stripping...",
+        ),
+        Task("normalization", lambda stripped: NormalizedVolume(stripped[0]), ("stripping",)),
+        Task(
+            "parcellation",
+            lambda normalized: parcellation(normalized, pnet_c, pnet_s, pnet_a, device),
+            ("normalization",),
+            threads=parcellation_threads,
+            memory=_stage_memory(PARCELLATION_MEMORY, device, 3, 142, 3),
+            message="Parcellating...",
+        ),
+        Task(
+            "hemisphere",
+            lambda normalized: hemisphere(normalized, hnet_c, hnet_a, device),
+            ("normalization",),
+            threads=max(1, threads - parcellation_threads),
+            memory=_stage_memory(HEMISPHERE_MEMORY, device, 1, 3, 2),
+            message="Hemisphere...",
+        ),
+        Task(
+            "postprocessing",
+            lambda stripped, parcellated, separated: postprocessing(parcellated, separated, stripped[1], device),
+            ("stripping", "parcellation", "hemisphere"),
+            message="Postprocessing...",
+        ),
+    ]
+    results = run_graph(tasks, threads, available_memory(device), log)
+    return results["preprocessing"], results["postprocessing"]
+
+
+def run_pipeline(
+    ipath,
+    output_dir,
+    basename,
+    models,
+    device,
+    level_dir="level",
+    log=None,
+    save_intermediates=False,
+    n4_profile=None,
+    n4_cache_dir=None,
+    result_cache=None,
+    n4_cache_bytes=None,
+):
+    """
+    Runs the whole pipeline on one T1 volume and writes the labelmap and the volume tables.
+
+    The wall time, CPU time, memory and slice throughput of every stage and view are written to
+    <basename>_run_report.json in the output directory.
+
+    Args:
+        ipath (str or SimpleITK.Image): The path of the input T1 image, or the image in memory.
+        output_dir (str): The directory where the outputs are saved.
+        basename (str): The base name for the output files.
+        models (tuple): The models returned by load_model.
+        device (torch.device): The device (CPU or GPU) on which the models are run.
+        level_dir (str or None): The directory containing the ROI level tables used by make_csv. If None, only
+            the labelmap is written.
+        log (callable, optional): Called with a short message before every stage.
+        save_intermediates (bool): Whether to also write intermediate images to the output directory.
+        n4_profile (str or dict, optional): The N4 bias-field correction profile, see preprocessing.n4_settings.
+        n4_cache_dir (str, optional): The directory of the bias-corrected image cache.
+        result_cache (ResultCache, optional): A cache of whole-pipeline results. A cached input skips inference.
+        n4_cache_bytes (int, optional): The size limit of the bias-corrected image cache.
+
+    Returns:
+        pandas.DataFrame or None: The Type1_Level5 volume table, or None without level tables.
+    """
+    log = log or (lambda message: None)
+    os.makedirs(output_dir, exist_ok=True)
+    report_path = os.path.join(output_dir, f"{basename}_run_report.json")
+    with run_report(report_path, input=basename, device=str(device)):
+        return _run_pipeline(
+            ipath,
+            output_dir,
+            basename,
+            models,
+            device,
+            level_dir,
+            log,
+            save_intermediates,
+            n4_profile,
+            n4_cache_dir,
+            result_cache,
+            n4_cache_bytes,
+        )
+
+
+def _run_pipeline(
+    ipath,
+    output_dir,
+    basename,
+    models,
+    device,
+    level_dir,
+    log,
+    save_intermediates,
+    n4_profile,
+    n4_cache_dir,
+    result_cache,
+    n4_cache_bytes,
+):
+    cached = None
+    if result_cache is not None:
+        ipath = read_image(ipath)
+        key = result_cache.key(ipath, n4_cache_settings(n4_settings(n4_profile)))
+        cached = result_cache.get(key)
+
+    if cached is not None:
+        log("Using cached result.")
+        aligned_output, affine, _ = cached
+    else:
+        data, aligned_output = run_inference(
+            ipath, output_dir, basename, models, device, log, save_intermediates, n4_profile, n4_cache_dir, n4_cache_bytes
+        )
+        affine = data.affine
+
+    def save_labelmap():
+        nii = nib.Nifti1Image(aligned_output.astype(np.uint16), affine=affine)
+        nib.save(nii, os.path.join(output_dir, f"{basename}_280_segment.nii.gz"))
+
+    # The labelmap and the volume tables only depend on the labels, so they are written concurrently. The
+    # level tables are cheap to rebuild, so they are written again for cached results as well
+    tasks = [Task("save_labelmap", save_labelmap, threads=1, message="Saving labelmap...")]
+    if level_dir is not None:
+        tasks.append(
+            Task(
+                "csv",
+                lambda: make_csv(aligned_output, output_dir, basename, level_dir),
+                threads=1,
+                message="Calculating volumes...",
+            )
+        )
+    results = run_graph(tasks, log=log)
+    df = results.get("csv")
+    if result_cache is not None and cached is None:
+        result_cache.put(key, aligned_output, affine, df)
+    return df
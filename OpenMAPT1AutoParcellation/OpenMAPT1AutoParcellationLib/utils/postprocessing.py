@@ -1,29 +1,55 @@
 import pickle
 import numpy as np
-import torch
 import os
+from functools import lru_cache
 
-def postprocessing(parcellated, separated, shift, device):
+from utils.functions import box_index
+
+
+@lru_cache(maxsize=None)
+def split_lookup_table():
+    """
+    Compiles split_map.pkl into a dense lookup table indexed by (hemisphere, parcel).
+
+    The table is built once per process. Pairs that are not in the split map are mapped to 0.
+
+    Returns:
+        numpy.ndarray: A read-only int16 array of shape (3, 142) or larger.
+    """
     split_map_path = os.path.join(os.path.dirname(__file__), "split_map.pkl")
     with open(split_map_path, "rb") as tf:
         dictionary = pickle.load(tf)
-    pmap = torch.tensor(parcellated.astype("int16"), requires_grad=False).to(device)
-    hmap = torch.tensor(separated.astype("int16"), requires_grad=False).to(device)
-    combined = torch.stack((torch.flatten(hmap), torch.flatten(pmap)), axis=-1)
-    output = torch.zeros_like(hmap).ravel()
-    for key, value in dictionary.items():
-        key = torch.tensor(key, requires_grad=False).to(device)
-        mask = torch.all(combined == key, axis=1)
-        output[mask] = value
-    output = output.reshape(hmap.shape)
-    output = output.cpu().detach().numpy()
+    n_hemispheres = max(3, max(int(h) for h, _ in dictionary) + 1)
+    n_parcels = max(142, max(int(p) for _, p in dictionary) + 1)
+    table = np.zeros((n_hemispheres, n_parcels), dtype="int16")
+    for (h, p), value in dictionary.items():
+        table[int(h), int(p)] = value
+    table.setflags(write=False)
+    return table
+
+
+def postprocessing(parcellated, separated, shift, device):
+    """
+    Maps the (hemisphere, parcel) pair of every voxel to its final label and moves the labelmap back
+    to the space of the conformed input image.
+
+    Args:
+        parcellated (numpy.ndarray): The parcellation labels (0-141).
+        separated (numpy.ndarray): The hemisphere labels (0-2).
+        shift (tuple of int): The shifts applied by stripping to center the brain.
+        device (torch.device): Unused; the lookup runs on the CPU. Kept for compatibility.
+
+    Returns:
+        numpy.ndarray: The labelmap of shape (256, 256, 256).
+    """
+    output = split_lookup_table()[separated.astype("intp"), parcellated.astype("intp")]
     output = output * (
         np.logical_or(
             np.logical_or(separated > 0, parcellated == 87), parcellated == 138
         )
     )
-    output = np.pad(
-        output, [(32, 32), (16, 16), (32, 32)], "constant", constant_values=0
-    )
-    output = np.roll(output, (-shift[0], -shift[1], -shift[2]), axis=(0, 1, 2))
-    return output
\ No newline at end of file
+
+    # Place the box back where padding and rolling it by -shift would, in a single scatter
+    aligned = np.zeros((256, 256, 256), dtype=output.dtype)
+    aligned[box_index(shift)] = output
+    return aligned
@@ -1,53 +1,220 @@
 import os
+import time
 
 import nibabel as nib
+import numpy as np
 import SimpleITK as sitk
 from nibabel import processing
 from nibabel.orientations import aff2axcodes, axcodes2ornt, ornt_transform
 
+from utils.functions import atomic_path, content_hash
 
-def N4_Bias_Field_Correction(input_path, output_path):
+# N4 performance profiles. None keeps the SimpleITK default (50 iterations at each of 4 levels,
+# convergence threshold 0.001, all available threads); "default" reproduces the original settings.
+N4_PROFILES = {
+    "default": {"shrink_factor": 4, "iterations": None, "convergence_threshold": None, "threads": None},
+    "fast": {"shrink_factor": 6, "iterations": [25, 25, 25], "convergence_threshold": 1e-4, "threads": None},
+    "accurate": {"shrink_factor": 2, "iterations": [50, 50, 50, 50], "convergence_threshold": 1e-7, "threads": None},
+}
+
+# N4 settings that only change how fast the correction runs, and are left out of cache keys
+N4_SPEED_SETTINGS = ("threads",)
+
+# Default size limit of the bias-corrected image cache; every entry is a full-resolution float32 image
+N4_CACHE_BYTES = 2 * 1024**3
+
+
+def read_image(image):
+    """
+    Returns the given image as a float32 SimpleITK image, reading it from disk if a path is given.
+
+    Args:
+        image (str or SimpleITK.Image): Path to an image file, or an image already in memory.
+
+    Returns:
+        SimpleITK.Image: The float32 image.
+    """
+    if isinstance(image, sitk.Image):
+        return sitk.Cast(image, sitk.sitkFloat32)
+    return sitk.ReadImage(image, sitk.sitkFloat32)
+
+
+def sitk_to_nibabel(image):
     """
-    Perform N4 Bias Field Correction on an input image and save the corrected image to the specified output path.
+    Converts a 3D SimpleITK image to a NIfTI image in memory, with the same geometry as writing it to a
+    NIfTI file and loading that file with nibabel.
 
     Args:
-        input_path (str): Path to the input image file.
-        output_path (str): Path to save the corrected image file.
+        image (SimpleITK.Image): The image to convert.
 
     Returns:
-        None
+        nibabel.Nifti1Image: The image with an RAS affine.
+    """
+    # SimpleITK arrays are indexed (z, y, x); nibabel expects (x, y, z)
+    voxel = sitk.GetArrayFromImage(image).transpose(2, 1, 0)
+    affine = np.eye(4)
+    affine[:3, :3] = np.array(image.GetDirection()).reshape(3, 3) * np.array(image.GetSpacing())
+    affine[:3, 3] = image.GetOrigin()
+    # ITK uses LPS coordinates, NIfTI uses RAS
+    affine = np.diag([-1.0, -1.0, 1.0, 1.0]) @ affine
+    return nib.Nifti1Image(voxel, affine)
+
+
+def n4_settings(profile=None):
+    """
+    Returns the N4 settings of a profile.
+
+    Args:
+        profile (str or dict, optional): The name of a profile in N4_PROFILES, or a dict overriding
+            settings of the "default" profile (shrink_factor, iterations, convergence_threshold, threads).
+
+    Returns:
+        dict: The complete settings.
+    """
+    settings = dict(N4_PROFILES["default"])
+    if isinstance(profile, str):
+        if profile not in N4_PROFILES:
+            raise ValueError(f"Unknown N4 profile: {profile}")
+        settings.update(N4_PROFILES[profile])
+    elif profile is not None:
+        unknown = set(profile) - set(settings)
+        if unknown:
+            raise ValueError("Unknown N4 setting(s): " + ", ".join(sorted(unknown)))
+        settings.update(profile)
+    return settings
+
+
+def n4_cache_settings(settings):
+    """
+    Returns the N4 settings that change the corrected image, as sorted (name, value) pairs for cache keys.
     """
-    raw_img_sitk = sitk.ReadImage(input_path, sitk.sitkFloat32)
+    return sorted((name, value) for name, value in settings.items() if name not in N4_SPEED_SETTINGS)
+
+
+def image_hash(image, *extra):
+    """
+    Hashes the voxel data and geometry of a SimpleITK image, together with any extra values.
+    """
+    return content_hash(
+        sitk.GetArrayViewFromImage(image), image.GetSpacing(), image.GetOrigin(), image.GetDirection(), *extra
+    )
+
+
+def evict_n4_cache(cache_dir, max_bytes=N4_CACHE_BYTES):
+    """
+    Removes the least recently used bias-corrected images until the cache fits in max_bytes.
+
+    Returns:
+        int: The number of removed images.
+    """
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if entry.is_file() and entry.name.endswith(".mha") and ".tmp" not in entry.name:
+            stat = entry.stat()
+            entries.append((stat.st_mtime, entry.path, stat.st_size))
+    entries.sort()
+    total = sum(size for _, _, size in entries)
+    removed = 0
+    for _, path, size in entries:
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+        removed += 1
+    return removed
+
+
+def N4_Bias_Field_Correction(input_path, output_path=None, profile=None, cache_dir=None, cache_bytes=None):
+    """
+    Perform N4 Bias Field Correction on an input image and optionally save the corrected image to the specified output path.
+
+    If a cache directory is given, the corrected image is stored there under the hash of the input voxels,
+    geometry and N4 settings except the thread count, and a later call with the same input returns it without running N4. The least
+    recently used images are removed once the cache grows beyond cache_bytes.
+
+    Args:
+        input_path (str or SimpleITK.Image): Path to the input image file, or the input image in memory.
+        output_path (str, optional): Path to save the corrected image file. If None, nothing is written.
+        profile (str or dict, optional): The N4 performance profile, see n4_settings. Default is "default".
+        cache_dir (str, optional): The directory of the corrected-image cache. If None, nothing is cached.
+        cache_bytes (int, optional): The size limit of the cache. Defaults to N4_CACHE_BYTES.
+
+    Returns:
+        SimpleITK.Image: The corrected image.
+    """
+    raw_img_sitk = read_image(input_path)
+    settings = n4_settings(profile)
+
+    cache_path = None
+    if cache_dir is not None:
+        cache_path = os.path.join(cache_dir, image_hash(raw_img_sitk, n4_cache_settings(settings)) + ".mha")
+        try:
+            corrected_image_full_resolution = sitk.ReadImage(cache_path, sitk.sitkFloat32)
+        except RuntimeError:
+            # Not cached, or evicted by another process in the meantime
+            corrected_image_full_resolution = None
+        if corrected_image_full_resolution is not None:
+            now = time.time()
+            os.utime(cache_path, (now, now))
+            if output_path is not None:
+                sitk.WriteImage(corrected_image_full_resolution, output_path)
+            return corrected_image_full_resolution
+
     transformed = sitk.RescaleIntensity(raw_img_sitk, 0, 255)
     transformed = sitk.LiThreshold(transformed, 0, 1)
     head_mask = transformed
-    shrinkFactor = 4
+    shrinkFactor = settings["shrink_factor"]
     inputImage = sitk.Shrink(raw_img_sitk, [shrinkFactor] * raw_img_sitk.GetDimension())
     maskImage = sitk.Shrink(head_mask, [shrinkFactor] * raw_img_sitk.GetDimension())
     bias_corrector = sitk.N4BiasFieldCorrectionImageFilter()
+    if settings["iterations"] is not None:
+        bias_corrector.SetMaximumNumberOfIterations([int(i) for i in settings["iterations"]])
+    if settings["convergence_threshold"] is not None:
+        bias_corrector.SetConvergenceThreshold(settings["convergence_threshold"])
+    if settings["threads"] is not None:
+        bias_corrector.SetNumberOfThreads(settings["threads"])
     corrected = bias_corrector.Execute(inputImage, maskImage)
     log_bias_field = bias_corrector.GetLogBiasFieldAsImage(raw_img_sitk)
     corrected_image_full_resolution = raw_img_sitk / sitk.Exp(log_bias_field)
-    sitk.WriteImage(corrected_image_full_resolution, output_path)
-    return
 
+    if cache_path is not None:
+        # Write under a temporary name first so that an interrupted run never leaves a partial entry
+        with atomic_path(cache_path, ".mha") as tmp_path:
+            sitk.WriteImage(corrected_image_full_resolution, tmp_path)
+        evict_n4_cache(cache_dir, N4_CACHE_BYTES if cache_bytes is None else cache_bytes)
+    if output_path is not None:
+        sitk.WriteImage(corrected_image_full_resolution, output_path)
+    return corrected_image_full_resolution
 
-def preprocessing(ipath, output_dir, basename):
+
+def preprocessing(
+    ipath, output_dir, basename, save_intermediates=False, n4_profile=None, n4_cache_dir=None, n4_cache_bytes=None
+):
     """
     Preprocesses a medical image by performing N4 bias field correction and conforming the image to a specified shape and voxel size.
 
+    The image is kept in memory between the steps; the bias-corrected image is only written to disk
+    as a debug output.
+
     Args:
-        ipath (str): The input file path of the medical image to be processed.
-        output_dir (str): The directory where the processed image will be saved.
+        ipath (str or SimpleITK.Image): The input file path of the medical image to be processed, or the image in memory.
+        output_dir (str): The directory where intermediate images are saved.
         basename (str): The base name for the output file.
+        save_intermediates (bool): Whether to save the bias-corrected image as <basename>_N4.nii.
+        n4_profile (str or dict, optional): The N4 performance profile, see n4_settings.
+        n4_cache_dir (str, optional): The directory of the bias-corrected image cache.
+        n4_cache_bytes (int, optional): The size limit of that cache. Defaults to N4_CACHE_BYTES.
 
     Returns:
         tuple: A tuple containing:
             - odata (nibabel.Nifti1Image): The N4 bias field corrected image.
             - data (nibabel.Nifti1Image): The conformed image with specified shape and voxel size.
     """
-    opath = os.path.join(output_dir, f"{basename}_N4.nii")
-    N4_Bias_Field_Correction(ipath, opath)
-    odata = nib.squeeze_image(nib.as_closest_canonical(nib.load(opath)))
+    opath = os.path.join(output_dir, f"{basename}_N4.nii") if save_intermediates else None
+    corrected = N4_Bias_Field_Correction(ipath, opath, n4_profile, n4_cache_dir, n4_cache_bytes)
+    odata = nib.squeeze_image(nib.as_closest_canonical(sitk_to_nibabel(corrected)))
     data = processing.conform(odata, out_shape=(256, 256, 256), voxel_size=(1.0, 1.0, 1.0), order=1)
     return odata, data
@@ -0,0 +1,225 @@
+import json
+import os
+import platform
+import sys
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+import torch
+
+from utils.progress import progress_stage
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# The report that stage() records into, set by run_report()
+_active = None
+_active_lock = threading.Lock()
+
+
+def peak_rss():
+    """
+    Returns the peak resident set size of the process in bytes, or None if it cannot be determined.
+    """
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+        return peak if sys.platform == "darwin" else peak * 1024
+    if psutil is not None:
+        info = psutil.Process().memory_info()
+        return getattr(info, "peak_wset", info.rss)
+    return None
+
+
+def current_rss():
+    """
+    Returns the current resident set size of the process in bytes, or None if it cannot be determined.
+    """
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def _mb(value):
+    return None if value is None else round(value / 1024**2, 1)
+
+
+class _PeakSampler:
+    """
+    Samples the resident set size, and the allocated CUDA memory if CUDA is available, on a background
+    thread while a with-block runs, and keeps the largest values.
+
+    Unlike ru_maxrss and torch.cuda.max_memory_allocated, which hold the peak of the whole process so far or
+    need a process-wide reset, this gives the peak during one stage. Spikes shorter than the interval can
+    be missed.
+    """
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.cuda = torch.cuda.is_available()
+        self.rss = None
+        self.cuda_allocated = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def sample(self):
+        rss = current_rss()
+        if rss is not None:
+            self.rss = max(self.rss or 0, rss)
+        if self.cuda:
+            self.cuda_allocated = max(self.cuda_allocated or 0, torch.cuda.memory_allocated())
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+    def __enter__(self):
+        self.sample()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+        self.sample()
+
+
+class RunReport:
+    """
+    Collects wall time, CPU time, memory and throughput of the pipeline stages of one run.
+
+    The memory peaks of a stage are sampled while it runs (see _PeakSampler). CPU time and memory are
+    measured for the whole process, so while stages of other threads run at the same time (parallel views,
+    concurrent graph tasks) they include the work of those stages. Such stages are recorded with
+    "concurrent": true and without cpu_s; their memory peaks are upper bounds.
+
+    Args:
+        **metadata: Values stored at the top level of the report, e.g. the input name or the device.
+    """
+
+    def __init__(self, **metadata):
+        self.metadata = metadata
+        self.stages = []
+        self._lock = threading.Lock()
+        self._running = {}
+        self._start = time.perf_counter()
+        self._cpu_start = time.process_time()
+        self._started = time.strftime("%Y-%m-%dT%H:%M:%S")
+
+    @contextmanager
+    def stage(self, name, slices=None):
+        """
+        Records a stage while the with-block runs.
+
+        Args:
+            name (str): The stage name, e.g. "parcellation.coronal".
+            slices (int, optional): The number of slices processed, used for slices/second.
+        """
+        # Stages of other threads that run at the same time mark each other as concurrent; nested stages
+        # of the same thread do not
+        thread = threading.get_ident()
+        state = {"thread": thread, "concurrent": False}
+        with self._lock:
+            for other in self._running.values():
+                if other["thread"] != thread:
+                    other["concurrent"] = state["concurrent"] = True
+            self._running[id(state)] = state
+
+        start = time.perf_counter()
+        cpu_start = time.process_time()
+        sampler = _PeakSampler()
+        try:
+            with sampler:
+                yield
+                if sampler.cuda:
+                    torch.cuda.synchronize()
+        finally:
+            wall = time.perf_counter() - start
+            cpu = time.process_time() - cpu_start
+            with self._lock:
+                del self._running[id(state)]
+            record = {
+                "name": name,
+                "wall_s": round(wall, 3),
+                "cpu_s": None if state["concurrent"] else round(cpu, 3),
+                "rss_mb": _mb(current_rss()),
+                "peak_rss_mb": _mb(sampler.rss),
+            }
+            if state["concurrent"]:
+                record["concurrent"] = True
+            if slices is not None:
+                record["slices"] = slices
+                record["slices_per_s"] = round(slices / wall, 2) if wall > 0 else None
+            if sampler.cuda:
+                record["cuda_peak_mb"] = _mb(sampler.cuda_allocated)
+            with self._lock:
+                self.stages.append(record)
+
+    def to_dict(self):
+        return {
+            **self.metadata,
+            "started": self._started,
+            "total_wall_s": round(time.perf_counter() - self._start, 3),
+            "total_cpu_s": round(time.process_time() - self._cpu_start, 3),
+            "peak_rss_mb": _mb(peak_rss()),
+            "torch_version": torch.__version__,
+            "torch_threads": torch.get_num_threads(),
+            "cpu_count": os.cpu_count(),
+            "platform": platform.platform(),
+            "stages": list(self.stages),
+        }
+
+    def save(self, path):
+        """
+        Writes the report as JSON.
+        """
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+
+@contextmanager
+def run_report(path=None, **metadata):
+    """
+    Makes a new RunReport the target of stage() while the with-block runs, and writes it to path at the end.
+
+    Args:
+        path (str, optional): Where to write the JSON report. If None, the report is not written.
+        **metadata: Values stored at the top level of the report.
+    """
+    global _active
+    report = RunReport(**metadata)
+    with _active_lock:
+        previous, _active = _active, report
+    try:
+        yield report
+    finally:
+        with _active_lock:
+            _active = previous
+        if path is not None:
+            report.save(path)
+
+
+@contextmanager
+def stage(name, slices=None):
+    """
+    Records a stage into the active run report and reports it to the active progress, if there are any.
+
+    Args:
+        name (str): The stage name, e.g. "parcellation.coronal".
+        slices (int, optional): The number of slices processed, used for slices/second.
+    """
+    report = _active
+    with progress_stage(name), nullcontext() if report is None else report.stage(name, slices):
+        yield
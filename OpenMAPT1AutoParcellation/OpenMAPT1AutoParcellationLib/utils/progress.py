@@ -0,0 +1,125 @@
+import threading
+from contextlib import contextmanager
+
+# The progress that stages and slice inference report into, set by track()
+_active = None
+_active_lock = threading.Lock()
+
+# The innermost stage of every thread, which slice progress is reported against
+_local = threading.local()
+
+
+class Cancelled(Exception):
+    """
+    Raised inside the pipeline when the run it belongs to was cancelled.
+    """
+
+
+class Progress:
+    """
+    The progress of one pipeline run, updated by the pipeline threads and polled by a user interface.
+
+    Every stage (see profiling.stage) counts as done when it ends, and infer_slices reports the fraction of
+    the slices done within the innermost stage of its thread. The overall fraction weighs the stages by the
+    given weights; stages without a weight only change the message.
+
+    Args:
+        weights (dict, optional): The relative cost of the stages, keyed by stage name.
+    """
+
+    def __init__(self, weights=None):
+        self.weights = dict(weights or {})
+        self.message = ""
+        self._done = {}
+        self._lock = threading.Lock()
+        self._cancelled = threading.Event()
+
+    def start(self, name):
+        """
+        Records that a stage started.
+        """
+        self.message = name
+
+    def update(self, name, fraction):
+        """
+        Records the fraction of a stage that is done.
+        """
+        with self._lock:
+            self._done[name] = max(self._done.get(name, 0.0), min(fraction, 1.0))
+
+    def fraction(self):
+        """
+        Returns the weighted fraction of the run that is done, between 0 and 1.
+        """
+        total = sum(self.weights.values())
+        if not total:
+            return 0.0
+        with self._lock:
+            return sum(weight * self._done.get(name, 0.0) for name, weight in self.weights.items()) / total
+
+    def cancel(self):
+        """
+        Asks the run to stop; it raises Cancelled at the next stage or batch of slices.
+        """
+        self._cancelled.set()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def check(self):
+        """
+        Raises Cancelled if the run was cancelled.
+        """
+        if self.cancelled:
+            raise Cancelled("The run was cancelled")
+
+
+@contextmanager
+def track(progress):
+    """
+    Makes a Progress the target of the stages and slice inference of the pipeline while the with-block runs.
+    """
+    global _active
+    with _active_lock:
+        previous, _active = _active, progress
+    try:
+        yield progress
+    finally:
+        with _active_lock:
+            _active = previous
+
+
+@contextmanager
+def progress_stage(name):
+    """
+    Reports a stage to the active progress, if there is one, and raises Cancelled before it starts if the
+    run was cancelled.
+    """
+    progress = _active
+    if progress is None:
+        yield
+        return
+    progress.check()
+    progress.start(name)
+    previous = getattr(_local, "stage", None)
+    _local.stage = name
+    try:
+        yield
+    finally:
+        _local.stage = previous
+    progress.update(name, 1.0)
+
+
+def report_slices(done, total):
+    """
+    Reports the slices done by the innermost stage of this thread, and raises Cancelled if the run was
+    cancelled.
+    """
+    progress = _active
+    if progress is None:
+        return
+    progress.check()
+    name = getattr(_local, "stage", None)
+    if name is not None and total:
+        progress.update(name, done / total)
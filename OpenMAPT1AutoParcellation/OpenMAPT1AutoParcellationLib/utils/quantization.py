@@ -0,0 +1,109 @@
+import copy
+import json
+import os
+
+import torch
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+from utils.functions import atomic_path
+
+# The checkpoints that can be replaced by INT8 models: the parcellation and hemisphere networks
+QUANTIZED_FILES = (
+    "PNet/coronal.pth",
+    "PNet/sagittal.pth",
+    "PNet/axial.pth",
+    "HNet/coronal.pth",
+    "HNet/axial.pth",
+)
+
+# Key of the metadata stored in the saved TorchScript files
+_METADATA = "openmap_int8.json"
+
+
+def quantized_engine():
+    """
+    Returns the quantized engine of this CPU, x86 if available and fbgemm otherwise.
+    """
+    engines = torch.backends.quantized.supported_engines
+    return "x86" if "x86" in engines else "fbgemm"
+
+
+def quantized_path(int8_dir, name):
+    """
+    Returns the path of the INT8 model of a checkpoint, e.g. <int8_dir>/PNet/coronal.int8.pt.
+    """
+    return os.path.join(int8_dir, os.path.splitext(name)[0] + ".int8.pt")
+
+
+def prepare(model, ch_in):
+    """
+    Inserts the calibration observers of post-training static quantisation into a copy of a float model.
+
+    The returned model computes in float32 and records the activation ranges of every call, so it can be
+    used in place of the float model by infer_slices while running the calibration volumes.
+
+    Args:
+        model (torch.nn.Module): The float model.
+        ch_in (int): The number of input channels of the model.
+
+    Returns:
+        torch.fx.GraphModule: The model with observers.
+    """
+    engine = quantized_engine()
+    torch.backends.quantized.engine = engine
+    model = copy.deepcopy(model).cpu().eval()
+    example_inputs = (torch.randn(1, ch_in, 64, 64),)
+    return prepare_fx(model, get_default_qconfig_mapping(engine), example_inputs)
+
+
+def convert(prepared, ch_in):
+    """
+    Converts a calibrated model to INT8 and freezes it as TorchScript.
+
+    Args:
+        prepared (torch.fx.GraphModule): The model returned by prepare(), after calibration.
+        ch_in (int): The number of input channels of the model.
+
+    Returns:
+        torch.jit.ScriptModule: The INT8 model, with float32 inputs and outputs.
+    """
+    quantized = convert_fx(prepared.eval())
+    with torch.no_grad():
+        traced = torch.jit.trace(quantized, torch.randn(1, ch_in, 64, 64))
+    return torch.jit.freeze(traced.eval())
+
+
+def save_quantized(model, path, checkpoint_hash):
+    """
+    Saves an INT8 model together with the SHA-256 hash of the float checkpoint it was calibrated from.
+    """
+    metadata = {"checkpoint_sha256": checkpoint_hash, "engine": quantized_engine(), "torch": torch.__version__}
+    with atomic_path(path) as tmp_path:
+        torch.jit.save(model, tmp_path, _extra_files={_METADATA: json.dumps(metadata)})
+
+
+def load_quantized(path, checkpoint_hash):
+    """
+    Loads an INT8 model saved by save_quantized.
+
+    Args:
+        path (str): The path of the INT8 model.
+        checkpoint_hash (str): The SHA-256 hash of the current float checkpoint.
+
+    Returns:
+        torch.jit.ScriptModule: The INT8 model on the CPU.
+
+    Raises:
+        FileNotFoundError: If the INT8 model does not exist.
+        RuntimeError: If it was calibrated from a different checkpoint.
+    """
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"{path} does not exist; create the INT8 models with openmap_quantize.py first")
+    extra_files = {_METADATA: ""}
+    model = torch.jit.load(path, map_location="cpu", _extra_files=extra_files)
+    metadata = json.loads(extra_files[_METADATA] or "{}")
+    if metadata.get("checkpoint_sha256") != checkpoint_hash:
+        raise RuntimeError(f"{path} was calibrated from a different checkpoint; run openmap_quantize.py again")
+    torch.backends.quantized.engine = metadata.get("engine", quantized_engine())
+    return model.eval()
@@ -0,0 +1,150 @@
+import os
+import shutil
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+from utils.functions import atomic_path
+from utils.inference import result_options
+from utils.load_model import model_fingerprint
+from utils.preprocessing import image_hash, read_image
+
+
+class ResultCache:
+    """
+    Content-addressed cache of whole-pipeline results.
+
+    An entry is keyed by the hash of the input voxels and geometry, the SHA-256 hashes of the model
+    weights and any extra settings that change the result, and holds the final labelmap, its affine and
+    the volume table. Entries are stored as <cache_dir>/<key>/ and the least recently used ones are
+    removed once the cache grows beyond max_bytes.
+
+    Args:
+        cache_dir (str): The directory of the cache.
+        model_folder (str): The model folder whose weights the results depend on.
+        max_bytes (int): The size limit of the cache on disk.
+        variant (tuple): Values identifying how the models were built, as returned by load_model._build_options.
+    """
+
+    def __init__(self, cache_dir, model_folder, max_bytes=2 * 1024**3, variant=()):
+        self.cache_dir = cache_dir
+        self.model_folder = model_folder
+        self.max_bytes = max_bytes
+        self.variant = variant
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, image, *extra):
+        """
+        Returns the cache key of an input image.
+
+        The configured inference options that change the labels (see inference.result_options) are
+        part of the key.
+
+        Args:
+            image (str or SimpleITK.Image): The input T1 image or its path.
+            *extra: Further values that change the result, e.g. preprocessing settings.
+
+        Returns:
+            str: The key.
+        """
+        return image_hash(
+            read_image(image),
+            model_fingerprint(self.model_folder, content_hash=True),
+            result_options(),
+            *self.variant,
+            *extra,
+        )
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def get(self, key):
+        """
+        Returns a cached result and marks it as recently used.
+
+        Returns:
+            tuple or None: (labelmap, affine, table), where table may be None, or None if the key is not cached.
+        """
+        path = self._path(key)
+        try:
+            with np.load(os.path.join(path, "labelmap.npz")) as f:
+                labelmap, affine = f["labelmap"], f["affine"]
+        except (OSError, KeyError, ValueError):
+            return None
+        table_path = os.path.join(path, "table.csv")
+        table = pd.read_csv(table_path) if os.path.exists(table_path) else None
+        now = time.time()
+        os.utime(path, (now, now))
+        return labelmap, affine, table
+
+    def put(self, key, labelmap, affine, table=None):
+        """
+        Stores a result and evicts the least recently used entries beyond the size limit.
+
+        Args:
+            key (str): The key returned by key().
+            labelmap (numpy.ndarray): The final labelmap.
+            affine (numpy.ndarray): The affine of the labelmap.
+            table (pandas.DataFrame, optional): The volume table.
+        """
+        path = self._path(key)
+        try:
+            with atomic_path(path) as tmp_path:
+                os.makedirs(tmp_path)
+                np.savez_compressed(
+                    os.path.join(tmp_path, "labelmap.npz"), labelmap=labelmap.astype(np.uint16), affine=affine
+                )
+                if table is not None:
+                    table.to_csv(os.path.join(tmp_path, "table.csv"), index=False)
+                # A directory cannot replace a non-empty one, so an older entry of the key is removed first
+                shutil.rmtree(path, ignore_errors=True)
+        except OSError:
+            # Another process may have stored the same key in the meantime
+            if not os.path.isdir(path):
+                raise
+        with self._lock:
+            self.evict()
+
+    def size(self):
+        """
+        Returns the size of all cache entries in bytes.
+        """
+        return sum(size for _, _, size in self._entries())
+
+    def _entries(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if not os.path.isdir(path) or name.endswith(".tmp"):
+                continue
+            size = sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+            entries.append((os.stat(path).st_mtime, path, size))
+        return entries
+
+    def evict(self, max_bytes=None):
+        """
+        Removes the least recently used entries until the cache fits in max_bytes.
+
+        Returns:
+            int: The number of removed entries.
+        """
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        entries = sorted(self._entries())
+        total = sum(size for _, _, size in entries)
+        removed = 0
+        for _, path, size in entries:
+            if total <= max_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+            removed += 1
+        return removed
+
+    def clear(self):
+        """
+        Removes all entries.
+        """
+        return self.evict(0)
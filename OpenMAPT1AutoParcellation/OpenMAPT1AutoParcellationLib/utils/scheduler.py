@@ -0,0 +1,107 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import torch
+
+from utils.functions import per_thread_num_threads
+from utils.profiling import stage
+
+
+class Task:
+    """
+    A step of a pipeline graph.
+
+    Args:
+        name (str): The unique name of the task, also recorded as a stage of the active run report.
+        fn (callable): Called with the results of the dependencies, in the order of deps.
+        deps (tuple of str): The names of the tasks whose results fn needs.
+        threads (int, optional): The torch intra-op threads of the task. None uses the whole CPU budget, so
+            the task runs alone.
+        memory (int): The estimated peak memory of the task in bytes.
+        message (str, optional): Logged when the task starts.
+    """
+
+    def __init__(self, name, fn, deps=(), threads=None, memory=0, message=None):
+        self.name = name
+        self.fn = fn
+        self.deps = tuple(deps)
+        self.threads = threads
+        self.memory = memory
+        self.message = message
+
+
+def _fits(task, running, cpu_budget, memory_budget):
+    # A task always runs if nothing else does; otherwise it must fit next to the running tasks
+    if not running:
+        return True
+    threads = sum(t.threads or cpu_budget for t in running) + (task.threads or cpu_budget)
+    memory = sum(t.memory for t in running) + task.memory
+    return threads <= cpu_budget and (memory_budget is None or memory <= memory_budget)
+
+
+def _run(task, args, threads):
+    torch.set_num_threads(threads)
+    with stage(task.name):
+        return task.fn(*args)
+
+
+def run_graph(tasks, cpu_budget=None, memory_budget=None, log=None):
+    """
+    Runs a dependency graph of tasks, starting every task as soon as its dependencies are done and it fits
+    in the CPU and memory budgets next to the tasks already running.
+
+    Tasks are started in the given order among those that are ready, and their messages are logged from the
+    calling thread, so log may update a user interface.
+
+    The CPU budget is shared by setting the torch threads of every task thread, which only works where the
+    thread count is per thread, as functions.per_thread_num_threads probes at runtime. Where it is
+    process-wide the tasks run one after another, each with the whole budget.
+
+    Args:
+        tasks (list of Task): The tasks of the graph.
+        cpu_budget (int, optional): The torch threads shared by concurrent tasks. Defaults to torch.get_num_threads().
+        memory_budget (int, optional): The bytes shared by concurrent tasks. None does not limit memory.
+        log (callable, optional): Called with the message of every task when it starts.
+
+    Returns:
+        dict: The result of every task, keyed by task name.
+    """
+    log = log or (lambda message: None)
+    names = {task.name for task in tasks}
+    for task in tasks:
+        unknown = set(task.deps) - names
+        if unknown:
+            raise ValueError(f"Task {task.name} depends on unknown task(s): " + ", ".join(sorted(unknown)))
+
+    threads = torch.get_num_threads()
+    cpu_budget = cpu_budget or threads
+    concurrent = per_thread_num_threads()
+    pending = list(tasks)
+    running = {}
+    results = {}
+    try:
+        with ThreadPoolExecutor(max(1, len(tasks))) as executor:
+            while pending or running:
+                for task in list(pending):
+                    if not all(dep in results for dep in task.deps):
+                        continue
+                    if running and not concurrent:
+                        break
+                    if not _fits(task, list(running.values()), cpu_budget, memory_budget):
+                        continue
+                    pending.remove(task)
+                    if task.message:
+                        log(task.message)
+                    args = [results[dep] for dep in task.deps]
+                    task_threads = min(task.threads or cpu_budget, cpu_budget) if concurrent else cpu_budget
+                    future = executor.submit(_run, task, args, task_threads)
+                    running[future] = task
+                if not running:
+                    raise ValueError("The task graph has a cycle: " + ", ".join(task.name for task in pending))
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    task = running.pop(future)
+                    results[task.name] = future.result()
+    finally:
+        torch.set_num_threads(threads)
+    return results
@@ -1,11 +1,11 @@
 import numpy as np
-import torch
 from scipy import ndimage
 
-from utils.functions import normalize
+from utils.functions import box_index, normalize
+from utils.inference import infer_slices, run_views
 
 
-def strip(voxel, model, device):
+def strip(voxel, model, device, batch_size=None):
     """
     Applies a given model to a 3D voxel array and returns the processed output.
 
@@ -13,34 +13,16 @@ def strip(voxel, model, device):
         voxel (numpy.ndarray): A 3D numpy array of shape (256, 256, 256) representing the input voxel data.
         model (torch.nn.Module): A PyTorch model to be used for processing the voxel data.
         device (torch.device): The device (CPU or GPU) on which the model and data should be loaded.
+        batch_size (int, optional): The number of slices per forward pass. Defaults to the configured value.
 
     Returns:
         torch.Tensor: A 3D tensor of shape (256, 256, 256) containing the processed output.
     """
-    # Set the model to evaluation mode
-    model.eval()
+    # Apply the model to every slice with a sigmoid activation
+    output = infer_slices(voxel, model, device, 1, activation="sigmoid", batch_size=batch_size)
 
-    # Disable gradient calculation for inference
-    with torch.inference_mode():
-        # Initialize an empty tensor to store the output
-        output = torch.zeros(256, 256, 256).to(device)
-
-        # Iterate over each slice in the voxel data
-        for i, v in enumerate(voxel):
-            # Reshape the slice to match the model's input dimensions
-            image = v.reshape(1, 1, 256, 256)
-
-            # Convert the numpy array to a PyTorch tensor and move it to the specified device
-            image = torch.tensor(image).to(device)
-
-            # Apply the model to the input image and apply the sigmoid activation function
-            x_out = torch.sigmoid(model(image)).detach()
-
-            # Store the output in the corresponding slice of the output tensor
-            output[i] = x_out
-
-        # Reshape the output tensor to the original voxel dimensions and return it
-        return output.reshape(256, 256, 256)
+    # Reshape the output tensor to the original voxel dimensions and return it
+    return output.reshape(256, 256, 256)
 
 
 def stripping(voxel, data, ssnet, device):
@@ -71,18 +53,17 @@ def stripping(voxel, data, ssnet, device):
     axial = voxel.transpose(2, 1, 0)
 
     # Apply the brain stripping model to each plane
-    out_c = strip(coronal, ssnet, device).permute(2, 0, 1)
-    out_s = strip(sagittal, ssnet, device)
-    out_a = strip(axial, ssnet, device).permute(2, 1, 0)
+    out_c, out_s, out_a = run_views(
+        ("stripping.coronal", len(coronal), lambda: strip(coronal, ssnet, device).permute(2, 0, 1)),
+        ("stripping.sagittal", len(sagittal), lambda: strip(sagittal, ssnet, device)),
+        ("stripping.axial", len(axial), lambda: strip(axial, ssnet, device).permute(2, 1, 0)),
+    )
 
     # Combine the results from the three planes and threshold the output
     out_e = ((out_c + out_s + out_a) / 3) > 0.5
     out_e = out_e.cpu().numpy()
 
-    # Multiply the original data by the thresholded output to get the stripped brain image
-    stripped = data.get_fdata() * out_e
-
-    # Calculate the center of mass of the stripped brain image
+    # Calculate the center of mass of the brain mask
     x, y, z = map(int, ndimage.center_of_mass(out_e))
 
     # Calculate the shifts needed to center the brain image
@@ -90,11 +71,11 @@ def stripping(voxel, data, ssnet, device):
     yd = 120 - y
     zd = 128 - z
 
-    # Apply the shifts to center the brain image
-    stripped = np.roll(stripped, (xd, yd, zd), axis=(0, 1, 2))
-
-    # Crop the centered brain image
-    stripped = stripped[32:-32, 16:-16, 32:-32]
+    # Gather the box of the centered brain from the float32 image and mask it in place, which equals
+    # rolling the masked image by the shifts and cropping it, without full-size copies
+    box = box_index((xd, yd, zd))
+    stripped = data.get_fdata(dtype=np.float32)[box]
+    stripped *= out_e[box]
 
     # Return the stripped brain image and the shifts applied
     return stripped, (xd, yd, zd)
@@ -0,0 +1,79 @@
+import os
+import threading
+
+import torch
+import torch.nn as nn
+
+from utils.functions import atomic_path, content_hash
+
+
+def _autocast_enabled(device_type):
+    try:
+        return torch.is_autocast_enabled(device_type)
+    except TypeError:
+        # torch < 2.4 only has the CUDA flag in is_autocast_enabled
+        return torch.is_autocast_cpu_enabled() if device_type == "cpu" else torch.is_autocast_enabled()
+
+
+class TracedModel(nn.Module):
+    """
+    Runs a model as frozen TorchScript graphs, one per input shape, instead of eager PyTorch.
+
+    The first call with a new input shape (channels, height, width) traces and freezes the model, which
+    folds the BatchNorm layers and removes the Python dispatch overhead of every layer. The graphs are saved
+    to the cache directory under a key of the checkpoint fingerprint, the input shape, the device type and
+    the torch version, so later processes load them instead of tracing again. The batch size is not part
+    of the key, since the UNet graph does not depend on it.
+
+    Calls under autocast (reduced precision) run the eager model.
+
+    Args:
+        model (torch.nn.Module): The model in evaluation mode.
+        cache_dir (str or None): The directory of the traced graphs. If None, graphs are kept in memory only.
+        fingerprint: A value identifying the model weights, e.g. load_model.file_fingerprint of the checkpoint.
+    """
+
+    def __init__(self, model, cache_dir=None, fingerprint=None):
+        super().__init__()
+        self.model = model.eval()
+        self.cache_dir = cache_dir
+        self.fingerprint = fingerprint
+        self._graphs = {}
+        self._lock = threading.Lock()
+
+    def _path(self, shape, device):
+        key = content_hash(self.fingerprint, shape, device.type, torch.__version__)
+        return os.path.join(self.cache_dir, key + ".pt")
+
+    def _trace(self, x):
+        # Trace outside inference mode, since inference tensors cannot be recorded into a graph
+        with torch.inference_mode(False), torch.no_grad():
+            graph = torch.jit.trace(self.model, x.clone())
+            return torch.jit.freeze(graph.eval())
+
+    def graph(self, x):
+        """
+        Returns the traced graph for the shape of the batch x, loading or tracing it on first use.
+        """
+        shape = tuple(x.shape[1:])
+        key = (shape, str(x.device))
+        if key in self._graphs:
+            return self._graphs[key]
+        with self._lock:
+            if key in self._graphs:
+                return self._graphs[key]
+            path = None if self.cache_dir is None else self._path(shape, x.device)
+            if path is not None and os.path.exists(path):
+                graph = torch.jit.load(path, map_location=x.device)
+            else:
+                graph = self._trace(x)
+                if path is not None:
+                    with atomic_path(path) as tmp_path:
+                        torch.jit.save(graph, tmp_path)
+            self._graphs[key] = graph
+            return graph
+
+    def forward(self, x):
+        if _autocast_enabled(x.device.type):
+            return self.model(x)
+        return self.graph(x)(x)
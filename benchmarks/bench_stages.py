@@ -0,0 +1,289 @@
+"""
+CPU benchmarks of the OpenMAP-T1 stages on synthetic data.
+
+The benchmarks use a synthetic 256^3 head phantom and randomly initialised network.UNet models, so they
+run on a CPU-only machine without downloading the trained models. Seeds and thread counts are fixed, and
+the JSON output records the git commit, so results of different commits can be compared directly:
+
+    python benchmarks/bench_stages.py --threads 8 --repeat 3 --output bench.json
+    python benchmarks/bench_stages.py --stages parcellate,postprocessing
+
+The timings measure throughput only; the labels produced by random weights are meaningless.
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import nibabel as nib
+import numpy as np
+import pandas as pd
+import torch
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPO_ROOT, "OpenMAPT1AutoParcellation", "OpenMAPT1AutoParcellationLib"))
+
+from utils.cropping import crop, cropping  # noqa: E402
+from utils.functions import NormalizedVolume, label_agreement, normalize  # noqa: E402
+from utils.hemisphere import hemisphere, separate  # noqa: E402
+from utils.inference import configure  # noqa: E402
+from utils.make_csv import LEVELS, make_csv  # noqa: E402
+from utils.network import UNet  # noqa: E402
+from utils.onnx_backend import OnnxModel  # noqa: E402
+from utils.parcellation import parcellate, parcellation  # noqa: E402
+from utils.postprocessing import postprocessing  # noqa: E402
+from utils.stripping import strip, stripping  # noqa: E402
+from utils.tracing import TracedModel  # noqa: E402
+
+STAGES = ("normalize", "crop", "strip", "parcellate", "separate", "postprocessing", "make_csv", "end_to_end")
+
+
+def phantom(shape=(256, 256, 256), seed=0):
+    """
+    Builds a T1-like head phantom: a scalp shell, a brain ellipsoid with grey/white contrast and noise.
+    """
+    rng = np.random.default_rng(seed)
+    x, y, z = np.ogrid[: shape[0], : shape[1], : shape[2]]
+    x = (x - shape[0] / 2) / (shape[0] * 0.38)
+    y = (y - shape[1] / 2) / (shape[1] * 0.45)
+    z = (z - shape[2] / 2) / (shape[2] * 0.40)
+    r = x**2 + y**2 + z**2
+    voxel = np.zeros(shape, dtype="float32")
+    voxel[r < 1.0] = 80
+    brain = r < 0.7
+    texture = 40 * np.sin(12 * x) * np.cos(10 * y) * np.sin(8 * z)
+    voxel[brain] = (250 + texture)[brain]
+    voxel += rng.normal(0, 5, shape).astype("float32")
+    np.clip(voxel, 0, None, out=voxel)
+    return voxel
+
+
+def random_models(seed=0, fuse_bn=True, channels_last=False):
+    """
+    Builds randomly initialised models with the shapes of the trained ones, in the order of load_model.
+
+    The output bias of CNet and SSNet is raised so that their masks cover the whole phantom, which keeps
+    the stages after cropping and stripping working on a realistic amount of data. As in load_model, the
+    BatchNorm layers are folded into the convolutions unless fuse_bn is False, and the weights are converted
+    to channels_last if requested.
+    """
+    torch.manual_seed(seed)
+    shapes = ((1, 1), (1, 1), (3, 142), (3, 142), (3, 142), (1, 3), (1, 3))
+    models = [UNet(ch_in, ch_out).eval() for ch_in, ch_out in shapes]
+    for model in models[:2]:
+        torch.nn.init.constant_(model.dconv0.bias, 5.0)
+    if fuse_bn:
+        models = [model.fuse() for model in models]
+    if channels_last:
+        models = [model.set_memory_format(torch.channels_last) for model in models]
+    return tuple(models)
+
+
+def synthetic_levels(level_dir):
+    """
+    Writes Level5.txt and ROI level tables with the layout of the real ones for the 280 labels.
+    """
+    regions = [f"ROI_{i}" for i in range(1, 281)]
+    with open(os.path.join(level_dir, "Level5.txt"), "w") as f:
+        for i, region in enumerate(regions, 1):
+            f.write(f"{i}\t{region}\n")
+    groups = {level: max(2, 280 // (4 * (k + 1))) for k, level in enumerate(LEVELS)}
+    numbers = {"ROI": regions, **{level: [i % n + 1 for i in range(280)] for level, n in groups.items()}}
+    names = {"ROI": regions, **{level: [f"{level}_{i % n + 1}" for i in range(280)] for level, n in groups.items()}}
+    pd.DataFrame(numbers).to_csv(os.path.join(level_dir, "Level_ROI_No.csv"), index=False)
+    pd.DataFrame(names).to_csv(os.path.join(level_dir, "Level_ROI_Name.csv"), index=False)
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def measure(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def build_cases(voxel, models, device, level_dir, output_dir):
+    cnet, ssnet, pnet_c, pnet_s, pnet_a, hnet_c, hnet_a = models
+    normalized = normalize(voxel)
+    stripped = normalized[32:-32, 16:-16, 32:-32]
+    rng = np.random.default_rng(0)
+    parcellated = rng.integers(0, 142, stripped.shape).astype("int64")
+    separated = rng.integers(0, 3, stripped.shape).astype("int16")
+    labels = rng.integers(0, 281, voxel.shape).astype("int16")
+    data = nib.Nifti1Image(voxel, np.eye(4))
+
+    def end_to_end():
+        cropped = cropping(data, cnet, device)
+        stripped_voxel, shift = stripping(cropped, data, ssnet, device)
+        normalized_voxel = NormalizedVolume(stripped_voxel)
+        parcels = parcellation(normalized_voxel, pnet_c, pnet_s, pnet_a, device)
+        hemispheres = hemisphere(normalized_voxel, hnet_c, hnet_a, device)
+        output = postprocessing(parcels, hemispheres, shift, device)
+        make_csv(output, output_dir, "bench", level_dir)
+
+    # name: (callable, number of slices processed or None)
+    return {
+        "normalize": (lambda: normalize(voxel), None),
+        "crop": (lambda: crop(normalized, cnet, device), 256),
+        "strip": (lambda: strip(normalized, ssnet, device), 256),
+        "parcellate": (lambda: parcellate(stripped.transpose(1, 2, 0), pnet_c, device, "c"), 224),
+        "separate": (lambda: separate(stripped.transpose(1, 2, 0), hnet_c, device, "c"), 224),
+        "postprocessing": (lambda: postprocessing(parcellated, separated, (0, 0, 0), device), None),
+        "make_csv": (lambda: make_csv(labels, output_dir, "bench", level_dir), None),
+        "end_to_end": (end_to_end, None),
+    }
+
+
+def precision_check(voxel, models, device, precision):
+    """
+    Compares the parcellation labels of a reduced-precision run with the float32 run.
+    """
+    _, _, pnet_c, pnet_s, pnet_a, _, _ = models
+    stripped = voxel[32:-32, 16:-16, 32:-32]
+    previous = configure(precision="fp32")
+    try:
+        reference = parcellation(stripped, pnet_c, pnet_s, pnet_a, device)
+        configure(precision=precision)
+        labels = parcellation(stripped, pnet_c, pnet_s, pnet_a, device)
+    finally:
+        configure(**previous)
+    return label_agreement(reference, labels)
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(description="Benchmark the OpenMAP-T1 stages on synthetic data.")
+    parser.add_argument("--stages", default=",".join(STAGES), help="Comma-separated stages to run")
+    parser.add_argument("--repeat", type=int, default=3, help="Timed runs per stage")
+    parser.add_argument("--warmup", type=int, default=1, help="Untimed runs per stage")
+    parser.add_argument("--threads", type=int, default=4, help="Torch intra-op threads")
+    parser.add_argument("--device", default="cpu", help="Torch device")
+    parser.add_argument("--precision", default="fp32", choices=["fp32", "bf16", "fp16"], help="Precision of the forward passes")
+    parser.add_argument("--no-fuse-bn", action="store_true", help="Keep the BatchNorm layers separate from the convolutions")
+    parser.add_argument("--skip-empty", action="store_true", help="Give slices of pure background the background class without running the models")
+    parser.add_argument("--parallel-views", action="store_true", help="Run the views of each stage concurrently")
+    parser.add_argument("--prefetch", type=int, default=2, help="Input batches prepared ahead on a background thread (0: none)")
+    parser.add_argument("--channels-last", action="store_true", help="Run the models and inputs in channels_last format")
+    parser.add_argument("--compare-channels-last", action="store_true", help="Time every stage in NCHW and in channels_last and report the speedup")
+    parser.add_argument("--backend", default="torch", choices=["torch", "onnx"], help="Execution backend of the models")
+    parser.add_argument("--trace", action="store_true", help="Run the models as traced TorchScript graphs")
+    parser.add_argument("--output", default=None, help="Write the results as JSON to this path")
+    return parser
+
+
+def time_stages(stages, voxel, device, opt, tmp, channels_last):
+    """
+    Times the stages with random models in the given memory format, and returns one result per stage.
+    """
+    configure(channels_last=channels_last)
+    models = tuple(model.to(device) for model in random_models(fuse_bn=not opt.no_fuse_bn, channels_last=channels_last))
+    # Graphs are traced or exported during the warm-up runs
+    if opt.backend == "onnx":
+        layout = "nhwc" if channels_last else "nchw"
+        models = tuple(OnnxModel(model, os.path.join(tmp, "onnx", layout), i) for i, model in enumerate(models))
+    elif opt.trace:
+        models = tuple(TracedModel(model) for model in models)
+    cases = build_cases(voxel, models, device, os.path.join(tmp, "level"), tmp)
+
+    results = []
+    for name in stages:
+        fn, slices = cases[name]
+        measure(fn, opt.warmup)
+        times = measure(fn, opt.repeat)
+        result = {
+            "stage": name,
+            "channels_last": channels_last,
+            "median_s": round(statistics.median(times), 4),
+            "min_s": round(min(times), 4),
+            "times_s": [round(t, 4) for t in times],
+        }
+        if slices is not None:
+            result["slices_per_s"] = round(slices / statistics.median(times), 2)
+        results.append(result)
+        line = f"{name:<16} {'nhwc' if channels_last else 'nchw'}  median {result['median_s']:9.3f} s   min {result['min_s']:9.3f} s"
+        if slices is not None:
+            line += f"   {result['slices_per_s']:8.2f} slices/s"
+        print(line)
+    return results, models
+
+
+def main(argv=None):
+    opt = create_parser().parse_args(argv)
+    stages = [name.strip() for name in opt.stages.split(",") if name.strip()]
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        raise SystemExit("Unknown stage(s): " + ", ".join(sorted(unknown)))
+
+    torch.set_num_threads(opt.threads)
+    configure(
+        precision=opt.precision,
+        channels_last=opt.channels_last,
+        prefetch=opt.prefetch,
+        parallel_views=opt.parallel_views,
+        skip_empty=opt.skip_empty,
+    )
+    device = torch.device(opt.device)
+    voxel = phantom()
+
+    # With --compare-channels-last, every stage is timed in both layouts with the same weights
+    layouts = (False, True) if opt.compare_channels_last else (opt.channels_last,)
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        level_dir = os.path.join(tmp, "level")
+        os.makedirs(level_dir)
+        synthetic_levels(level_dir)
+        for channels_last in layouts:
+            layout_results, models = time_stages(stages, voxel, device, opt, tmp, channels_last)
+            results.extend(layout_results)
+
+    speedup = None
+    if opt.compare_channels_last:
+        median = {(r["stage"], r["channels_last"]): r["median_s"] for r in results}
+        speedup = {name: round(median[name, False] / median[name, True], 3) for name in stages if median[name, True] > 0}
+        for name, value in speedup.items():
+            print(f"{name:<16} channels_last speedup {value:6.3f}x")
+
+    report = {
+        "commit": git_commit(),
+        "torch_version": torch.__version__,
+        "numpy_version": np.__version__,
+        "threads": opt.threads,
+        "device": str(device),
+        "cpu_count": os.cpu_count(),
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "repeat": opt.repeat,
+        "precision": opt.precision,
+        "fuse_bn": not opt.no_fuse_bn,
+        "channels_last": opt.channels_last if not opt.compare_channels_last else "compared",
+        "channels_last_speedup": speedup,
+        "prefetch": opt.prefetch,
+        "parallel_views": opt.parallel_views,
+        "skip_empty": opt.skip_empty,
+        "backend": opt.backend,
+        "trace": opt.trace,
+        "results": results,
+    }
+    if opt.precision != "fp32":
+        report["precision_check"] = precision_check(voxel, models, device, opt.precision)
+        print(f"labels differing from fp32: {report['precision_check']['fraction_differing']:.4%}")
+    if opt.output:
+        with open(opt.output, "w") as f:
+            json.dump(report, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,19 @@
+import os
+import sys
+
+import pytest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPO_ROOT, "OpenMAPT1AutoParcellation", "OpenMAPT1AutoParcellationLib"))
+sys.path.insert(0, os.path.join(REPO_ROOT, "benchmarks"))
+
+
+@pytest.fixture
+def level_dir(tmp_path):
+    """
+    A directory with the synthetic level tables of the benchmarks.
+    """
+    from bench_stages import synthetic_levels
+
+    synthetic_levels(str(tmp_path))
+    return str(tmp_path)
@@ -0,0 +1,46 @@
+"""
+Checks the vectorised helpers of utils.functions against the code they replaced.
+"""
+import numpy as np
+import pytest
+
+from utils.functions import NormalizedVolume, box_index
+
+
+def reference_normalize(voxel):
+    # utils.functions.normalize before NormalizedVolume
+    nonzero = voxel[voxel > 0]
+    voxel = np.clip(voxel, 0, np.mean(nonzero) + np.std(nonzero) * 2)
+    voxel = (voxel - np.min(voxel)) / (np.max(voxel) - np.min(voxel))
+    voxel = (voxel * 2) - 1
+    return voxel.astype("float32")
+
+
+@pytest.mark.parametrize("shift", [(0, 0, 0), (7, -13, 100), (-128, 127, 128), (31, 5, -64)])
+def test_box_index_matches_roll_and_crop(shift):
+    rng = np.random.default_rng(0)
+    volume = rng.integers(-1000, 1000, (256, 256, 256), dtype=np.int16)
+    expected = np.roll(volume, shift, axis=(0, 1, 2))[32:-32, 16:-16, 32:-32]
+    np.testing.assert_array_equal(volume[box_index(shift)], expected)
+
+
+@pytest.mark.parametrize("shift", [(0, 0, 0), (7, -13, 100), (-128, 127, 128)])
+def test_box_index_scatter_matches_pad_and_roll(shift):
+    rng = np.random.default_rng(1)
+    box = rng.integers(0, 281, (192, 224, 192), dtype=np.int16)
+    padded = np.pad(box, [(32, 32), (16, 16), (32, 32)], "constant", constant_values=0)
+    expected = np.roll(padded, (-shift[0], -shift[1], -shift[2]), axis=(0, 1, 2))
+    aligned = np.zeros((256, 256, 256), dtype=box.dtype)
+    aligned[box_index(shift)] = box
+    np.testing.assert_array_equal(aligned, expected)
+
+
+@pytest.mark.parametrize("dtype", ["float64", "float32"])
+def test_normalized_volume_matches_normalize(dtype):
+    rng = np.random.default_rng(2)
+    voxel = rng.gamma(2.0, 60.0, (40, 48, 36))
+    voxel[rng.random(voxel.shape) < 0.3] = 0
+    voxel = voxel.astype(dtype)
+    expected = reference_normalize(voxel.astype("float64"))
+    # The statistics are accumulated block by block, so they match up to float64 rounding
+    np.testing.assert_allclose(NormalizedVolume(voxel, block_slices=7).voxel, expected, rtol=0, atol=1e-6)
@@ -0,0 +1,93 @@
+"""
+Checks the slice-inference engine on a small random UNet.
+"""
+import threading
+
+import numpy as np
+import pytest
+import torch
+
+from utils import inference
+from utils.functions import per_thread_num_threads
+from utils.inference import infer_slices, run_views
+from utils.network import UNet
+
+
+@pytest.fixture(scope="module")
+def unet():
+    torch.manual_seed(0)
+    return UNet(3, 5).eval()
+
+
+def masked_volume(seed=0):
+    # A (12, 16, 32) volume at its minimum everywhere but in slices 4 to 7
+    rng = np.random.default_rng(seed)
+    voxel = np.full((12, 16, 32), -1.0, dtype="float32")
+    voxel[4:8] = rng.uniform(-1, 1, (4, 16, 32))
+    return voxel
+
+
+def test_skip_empty_only_changes_slices_of_pure_background(unet):
+    voxel = masked_volume()
+    kwargs = dict(activation="softmax", context=1, batch_size=4, prefetch=0)
+    full = infer_slices(voxel, unet, "cpu", 5, skip_empty=False, **kwargs)
+    skipped = infer_slices(voxel, unet, "cpu", 5, skip_empty=True, **kwargs)
+
+    # Slices 3 to 8 have foreground in their three-slice input window and run through the model
+    torch.testing.assert_close(skipped[3:9], full[3:9], rtol=0, atol=1e-6)
+    background = torch.zeros(5, 16, 32)
+    background[0] = 1
+    for s in (*range(3), *range(9, 12)):
+        torch.testing.assert_close(skipped[s], background, rtol=0, atol=0)
+
+
+def test_batches_match_single_slices(unet):
+    voxel = np.random.default_rng(1).uniform(-1, 1, (10, 16, 32)).astype("float32")
+    single = infer_slices(voxel, unet, "cpu", 5, context=1, batch_size=1, prefetch=0)
+    for batch_size, prefetch in ((4, 0), (3, 2), (16, 1)):
+        batched = infer_slices(voxel, unet, "cpu", 5, context=1, batch_size=batch_size, prefetch=prefetch)
+        torch.testing.assert_close(batched, single, rtol=0, atol=1e-6)
+
+
+def test_context_pads_with_the_volume_minimum(unet):
+    voxel = np.random.default_rng(2).uniform(-1, 1, (6, 16, 32)).astype("float32")
+    output = infer_slices(voxel, unet, "cpu", 5, context=1, batch_size=2, prefetch=0)
+    padded = np.concatenate([np.full((1, 16, 32), voxel.min()), voxel, np.full((1, 16, 32), voxel.min())])
+    for s in range(len(voxel)):
+        with torch.inference_mode():
+            expected = torch.softmax(unet(torch.from_numpy(padded[s:s + 3][None].astype("float32"))), 1)[0]
+        torch.testing.assert_close(output[s], expected, rtol=0, atol=1e-6)
+
+
+def test_permuted_accumulation_matches_summed_views():
+    # The three views of a volume, accumulated through permuted views as in the streaming fusion of parcellation
+    torch.manual_seed(1)
+    models = [UNet(3, 5).eval() for _ in range(3)]
+    voxel = np.random.default_rng(3).uniform(-1, 1, (16, 32, 48)).astype("float32")
+    views = (
+        (voxel.transpose(1, 2, 0), (2, 0, 3, 1), (1, 3, 0, 2)),
+        (voxel, (1, 0, 2, 3), (1, 0, 2, 3)),
+        (voxel.transpose(2, 1, 0), (3, 0, 2, 1), (1, 3, 2, 0)),
+    )
+
+    accumulator = torch.zeros(5, 16, 32, 48)
+    expected = torch.zeros(5, 16, 32, 48)
+    for model, (view, inverse, permutation) in zip(models, views):
+        infer_slices(view, model, "cpu", 5, context=1, output=accumulator.permute(*inverse), batch_size=5, accumulate=True)
+        box = infer_slices(view, model, "cpu", 5, context=1, batch_size=1, prefetch=0)
+        expected += box.permute(*permutation)
+    torch.testing.assert_close(accumulator, expected, rtol=0, atol=1e-6)
+
+
+def test_per_thread_num_threads_keeps_the_thread_count():
+    threads = torch.get_num_threads()
+    per_thread_num_threads.__wrapped__()
+    assert torch.get_num_threads() == threads
+
+
+def test_run_views_is_sequential_without_per_thread_counts(monkeypatch):
+    monkeypatch.setattr(inference, "per_thread_num_threads", lambda: False)
+    threads = torch.get_num_threads()
+    caller = threading.get_ident()
+    views = [(f"view{i}", 1, lambda: (threading.get_ident(), torch.get_num_threads())) for i in range(3)]
+    assert run_views(*views, parallel=True) == [(caller, threads)] * 3
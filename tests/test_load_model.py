@@ -0,0 +1,43 @@
+"""
+Checks which model sets the process-wide model cache keeps.
+"""
+import os
+from types import SimpleNamespace
+
+import pytest
+
+from utils import load_model as load_model_module
+from utils.load_model import MODEL_FILES, evict_models, load_model
+
+
+@pytest.fixture
+def model_folder(tmp_path, monkeypatch):
+    # Empty checkpoints, with the loading replaced by a counter, since only the cache keys matter here
+    for name, _, _ in MODEL_FILES:
+        os.makedirs(os.path.dirname(tmp_path / name), exist_ok=True)
+        (tmp_path / name).write_bytes(b"")
+    loads = []
+    monkeypatch.setattr(load_model_module, "_load_models", lambda opt, device: loads.append(opt) or object())
+    yield str(tmp_path), loads
+    evict_models(str(tmp_path))
+
+
+def test_variants_of_the_same_checkpoints_stay_cached(model_folder):
+    folder, loads = model_folder
+    fused = load_model(SimpleNamespace(m=folder), "cpu")
+    unfused = load_model(SimpleNamespace(m=folder, fuse_bn=False), "cpu")
+    assert load_model(SimpleNamespace(m=folder), "cpu") is fused
+    assert load_model(SimpleNamespace(m=folder, fuse_bn=False), "cpu") is unfused
+    assert len(loads) == 2
+
+
+def test_changed_checkpoints_replace_every_variant(model_folder):
+    folder, loads = model_folder
+    load_model(SimpleNamespace(m=folder), "cpu")
+    load_model(SimpleNamespace(m=folder, fuse_bn=False), "cpu")
+    with open(os.path.join(folder, MODEL_FILES[0][0]), "wb") as f:
+        f.write(b"changed")
+    load_model(SimpleNamespace(m=folder), "cpu")
+    assert len(load_model_module._model_cache) == 1
+    load_model(SimpleNamespace(m=folder, fuse_bn=False), "cpu")
+    assert len(loads) == 4
@@ -0,0 +1,53 @@
+"""
+Checks the matrix aggregation of the level tables against the per-level loop it replaced.
+"""
+import os
+from collections import defaultdict
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from utils.make_csv import LEVELS, aggregate_levels, count_labels
+
+
+def reference_change_level(df, level, sulcus, level_dir):
+    # make_csv.change_level before aggregate_levels
+    ROI_number = pd.read_csv(os.path.join(level_dir, "Level_ROI_No.csv"))
+    ROI_name = pd.read_csv(os.path.join(level_dir, "Level_ROI_Name.csv"))
+    if sulcus == False:
+        tmp = ROI_number["Type1_Level2"]
+        ROI_number = ROI_number[tmp != 18]
+        ROI_number = ROI_number[tmp != 19]
+        ROI_name = ROI_name[tmp != 18]
+        ROI_name = ROI_name[tmp != 19]
+    data = dict(zip(ROI_number["ROI"], ROI_number[level]))
+    level_dict = defaultdict(list)
+    for key, value in data.items():
+        level_dict[str(value)].append(key)
+    change_df_list = []
+    for i, (key, value) in enumerate(level_dict.items()):
+        name = ROI_name[level].unique()[i]
+        change_df_list.append(df[value].sum(axis=1).rename(name))
+    return pd.concat(change_df_list, axis=1)
+
+
+@pytest.mark.parametrize("sulcus", [True, False])
+def test_aggregate_levels_matches_change_level(level_dir, sulcus):
+    # The synthetic tables number the regions ROI_1 to ROI_280; Type1_Level2 includes the sulcus groups 18 and 19
+    regions = [f"ROI_{i}" for i in range(1, 281)]
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame(rng.integers(0, 50000, (3, len(regions))).astype("float64"), columns=regions)
+    levels = aggregate_levels(df, LEVELS, sulcus, level_dir)
+    for level in LEVELS:
+        expected = reference_change_level(df, level, sulcus, level_dir)
+        pd.testing.assert_frame_equal(levels[level], expected)
+
+
+def test_count_labels_matches_unique():
+    rng = np.random.default_rng(1)
+    labels = rng.integers(0, 281, (32, 32, 32))
+    values, counts = np.unique(labels, return_counts=True)
+    expected = np.zeros(281, dtype=counts.dtype)
+    expected[values] = counts
+    np.testing.assert_array_equal(count_labels(labels), expected)
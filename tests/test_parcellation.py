@@ -0,0 +1,33 @@
+"""
+Checks that the streaming view fusion gives the labels of the per-view boxes.
+"""
+import numpy as np
+import pytest
+import torch
+
+from utils.inference import configure
+from utils.network import UNet
+from utils.parcellation import parcellation
+
+
+@pytest.fixture(scope="module")
+def models():
+    # The output layer is scaled up so that the argmax varies over the volume instead of picking one parcel
+    torch.manual_seed(0)
+    models = [UNet(3, 142).eval() for _ in range(3)]
+    for model in models:
+        torch.nn.init.normal_(model.dconv0.weight, std=5.0)
+    return models
+
+
+def test_stream_fusion_matches_box_fusion(models):
+    voxel = np.random.default_rng(0).uniform(-1, 1, (16, 32, 48)).astype("float32")
+    previous = configure(prefetch=0)
+    try:
+        boxes = parcellation(voxel, *models, "cpu", batch_size=1, fusion="box")
+    finally:
+        configure(**previous)
+    streamed = parcellation(voxel, *models, "cpu", batch_size=5, fusion="stream")
+    assert streamed.shape == (16, 32, 48)
+    assert len(np.unique(streamed)) > 1
+    np.testing.assert_array_equal(streamed, boxes)
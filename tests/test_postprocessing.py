@@ -0,0 +1,28 @@
+"""
+Checks the precompiled split lookup table against the split map loop it replaced.
+"""
+import os
+import pickle
+
+import numpy as np
+
+from utils import postprocessing
+from utils.postprocessing import split_lookup_table
+
+
+def reference_split(parcellated, separated):
+    # The loop of postprocessing before split_lookup_table, one mask per (hemisphere, parcel) pair
+    with open(os.path.join(os.path.dirname(postprocessing.__file__), "split_map.pkl"), "rb") as f:
+        dictionary = pickle.load(f)
+    output = np.zeros(parcellated.shape, dtype="int16")
+    for (h, p), value in dictionary.items():
+        output[(separated == h) & (parcellated == p)] = value
+    return output
+
+
+def test_split_lookup_table_matches_dict_loop():
+    rng = np.random.default_rng(0)
+    parcellated = rng.integers(0, 142, (24, 28, 24))
+    separated = rng.integers(0, 3, (24, 28, 24))
+    output = split_lookup_table()[separated.astype("intp"), parcellated.astype("intp")]
+    np.testing.assert_array_equal(output, reference_split(parcellated, separated))
@@ -0,0 +1,27 @@
+"""
+Checks the keys of the bias-corrected image cache.
+"""
+import os
+
+import numpy as np
+import SimpleITK as sitk
+
+from utils.preprocessing import N4_Bias_Field_Correction
+
+
+def test_thread_count_does_not_change_the_n4_cache_key(tmp_path):
+    rng = np.random.default_rng(0)
+    voxel = np.zeros((24, 24, 24), dtype="float32")
+    voxel[4:20, 4:20, 4:20] = rng.uniform(100, 200, (16, 16, 16))
+    image = sitk.GetImageFromArray(voxel)
+    cache_dir = str(tmp_path)
+
+    profile = {"iterations": [5], "threads": 1}
+    first = N4_Bias_Field_Correction(image, profile=profile, cache_dir=cache_dir)
+    assert len(os.listdir(cache_dir)) == 1
+    second = N4_Bias_Field_Correction(image, profile={**profile, "threads": 2}, cache_dir=cache_dir)
+    assert len(os.listdir(cache_dir)) == 1
+    np.testing.assert_allclose(sitk.GetArrayFromImage(second), sitk.GetArrayFromImage(first), rtol=1e-6)
+
+    N4_Bias_Field_Correction(image, profile={**profile, "iterations": [6]}, cache_dir=cache_dir)
+    assert len(os.listdir(cache_dir)) == 2
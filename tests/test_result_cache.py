@@ -0,0 +1,26 @@
+"""
+Checks that results of differently built models get different result cache keys.
+"""
+import os
+from types import SimpleNamespace
+
+import nibabel as nib
+import numpy as np
+
+from utils.load_model import MODEL_FILES, _build_options
+from utils.result_cache import ResultCache
+
+
+def test_build_options_are_part_of_the_key(tmp_path):
+    model_folder = tmp_path / "models"
+    for name, _, _ in MODEL_FILES:
+        os.makedirs(os.path.dirname(model_folder / name), exist_ok=True)
+        (model_folder / name).write_bytes(name.encode())
+    image = str(tmp_path / "t1.nii.gz")
+    nib.save(nib.Nifti1Image(np.arange(8 * 8 * 8, dtype="int16").reshape(8, 8, 8), np.eye(4)), image)
+
+    keys = set()
+    for options in ({}, {"backend": "onnx"}, {"fuse_bn": False}, {"int8": True}, {"trace": True}):
+        variant = _build_options(SimpleNamespace(m=str(model_folder), **options))
+        keys.add(ResultCache(str(tmp_path / "cache"), str(model_folder), variant=variant).key(image))
+    assert len(keys) == 5
@@ -0,0 +1,45 @@
+"""
+Checks how the task graph shares the CPU between tasks.
+"""
+import threading
+import time
+
+import pytest
+import torch
+
+from utils import scheduler
+from utils.scheduler import Task, run_graph
+
+
+def overlap_of(tasks):
+    # Runs the tasks through fns that record how many of them run at the same time
+    lock = threading.Lock()
+    state = {"running": 0, "most": 0, "threads": []}
+
+    def fn():
+        with lock:
+            state["running"] += 1
+            state["most"] = max(state["most"], state["running"])
+            state["threads"].append(torch.get_num_threads())
+        time.sleep(0.05)
+        with lock:
+            state["running"] -= 1
+
+    run_graph([Task(name, fn, threads=threads) for name, threads in tasks], cpu_budget=4)
+    return state
+
+
+def test_tasks_run_one_at_a_time_without_per_thread_counts(monkeypatch):
+    monkeypatch.setattr(scheduler, "per_thread_num_threads", lambda: False)
+    threads = torch.get_num_threads()
+    state = overlap_of([("parcellation", 3), ("hemisphere", 1)])
+    assert state["most"] == 1
+    assert state["threads"] == [4, 4]
+    assert torch.get_num_threads() == threads
+
+
+@pytest.mark.skipif(not scheduler.per_thread_num_threads(), reason="torch.set_num_threads is process-wide")
+def test_tasks_share_the_cpu_with_per_thread_counts():
+    state = overlap_of([("parcellation", 3), ("hemisphere", 1)])
+    assert state["most"] == 2
+    assert sorted(state["threads"]) == [1, 3]
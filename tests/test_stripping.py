@@ -0,0 +1,77 @@
+"""
+Checks cropping and stripping on the float32 image against the float64 code they replaced.
+"""
+import nibabel as nib
+import numpy as np
+import pytest
+import torch
+from scipy import ndimage
+
+from bench_stages import phantom
+from utils.cropping import closing, crop, cropping
+from utils.functions import normalize
+from utils.stripping import strip, stripping
+
+
+def threshold_model(voxel, raw):
+    # A 1x1 convolution whose sigmoid output is above 0.5 where the normalized input is above the normalized raw value
+    nonzero = voxel[voxel > 0]
+    upper = np.mean(nonzero) + 2 * np.std(nonzero)
+    threshold = raw / upper * 2 - 1
+    model = torch.nn.Conv2d(1, 1, 1)
+    with torch.no_grad():
+        model.weight.fill_(50.0)
+        model.bias.fill_(-50.0 * threshold)
+    return model.eval()
+
+
+def reference_cropping(data, cnet):
+    # cropping before the float32 image, with float64 voxels
+    voxel = normalize(data.get_fdata())
+    out_c = crop(voxel.transpose(1, 2, 0), cnet, "cpu").permute(2, 0, 1)
+    out_s = crop(voxel, cnet, "cpu")
+    out_e = closing((((out_c + out_s) / 2) > 0.5).cpu().numpy())
+    return data.get_fdata() * out_e
+
+
+def reference_stripping(voxel, data, ssnet):
+    # stripping before box_index, with float64 voxels
+    voxel = normalize(voxel)
+    out_c = strip(voxel.transpose(1, 2, 0), ssnet, "cpu").permute(2, 0, 1)
+    out_s = strip(voxel, ssnet, "cpu")
+    out_a = strip(voxel.transpose(2, 1, 0), ssnet, "cpu").permute(2, 1, 0)
+    out_e = (((out_c + out_s + out_a) / 3) > 0.5).cpu().numpy()
+    stripped = data.get_fdata() * out_e
+    x, y, z = map(int, ndimage.center_of_mass(out_e))
+    shift = (128 - x, 120 - y, 128 - z)
+    stripped = np.roll(stripped, shift, axis=(0, 1, 2))
+    return stripped[32:-32, 16:-16, 32:-32], shift
+
+
+@pytest.fixture(scope="module")
+def head():
+    # An integer-valued phantom, shifted off centre so that stripping has to move the brain
+    return np.roll(np.rint(phantom()).astype("int16"), (9, -6, 4), axis=(0, 1, 2))
+
+
+def test_cropping_and_stripping_match_float64(head):
+    # The scalp lies around 80 and the brain around 250; the thresholds keep the head and the brain
+    cnet = threshold_model(head, 40.5)
+    ssnet = threshold_model(head, 150.5)
+
+    data64 = nib.Nifti1Image(head, np.eye(4))
+    expected_cropped = reference_cropping(data64, cnet)
+    expected_stripped, expected_shift = reference_stripping(expected_cropped, data64, ssnet)
+
+    data32 = nib.Nifti1Image(head, np.eye(4))
+    cropped = cropping(data32, cnet, "cpu")
+    assert cropped.dtype == np.float32
+    np.testing.assert_array_equal(cropped, expected_cropped)
+
+    stripped, shift = stripping(cropped, data32, ssnet, "cpu")
+    assert shift == expected_shift
+    assert stripped.dtype == np.float32
+    np.testing.assert_array_equal(stripped, expected_stripped)
+
+    # The masking is done on copies, so the image keeps its voxels for later stages
+    np.testing.assert_array_equal(data32.get_fdata(dtype=np.float32), head)